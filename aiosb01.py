@@ -0,0 +1,579 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        aiosb01.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# asyncio client for the SB01 bootloader. AsyncSB01 sends the commands
+# through a transport. FdTransport lets the event loop wait on the file
+# descriptor of a serial port or pty, so many boards can be served from one
+# thread:
+#
+#     async def crc(port):
+#         board = await AsyncSB01.open(port)
+#         try:
+#             return await board.get_crc()
+#         finally:
+#             board.close()
+#
+#     asyncio.run(asyncio.gather(crc("/dev/ttyUSB0"), crc("/dev/ttyUSB1")))
+#
+# BlockingTransport is used where there is no such file descriptor, on
+# Windows and for the in-process emulator. Its reads block the event loop.
+# downloader.SB01 runs these coroutines on an event loop of its own.
+#
+# Each command waits at most a timeout for its response. If it is not given
+# in the call, it is found from the round-trip times measured for the
+# command, limited by AsyncSB01.timeouts. A command without a response is
+# sent again after the line has been quiet for that time, and a data frame
+# after moving the address back. Set metrics to a metrics.Metrics
+# object to record the response times and errors of the commands.
+
+import asyncio
+import math
+import os
+import time
+import serial
+from protocol import ERASE_CMD, ADR_CMD, DATA_CMD1, AUX_CMD, CRC_CMD, START_CMD, REV_CMD, READ_WORD, READ_DWORD, \
+    OK_RESP, DATA_CMDS, DEFAULT_BAUDRATE
+from profiles import SB01
+
+# Names of the commands in timeouts and metrics
+_NAMES = dict([(ERASE_CMD, "erase"), (ADR_CMD, "adr")] + [(cmd, "data") for cmd in DATA_CMDS])
+
+_OK = bytes([OK_RESP])
+
+
+class BlockingTransport(object):
+    """ Transport on a serial-like object with blocking reads """
+
+    def __init__(self, com):
+        self.com = com
+        # The emulator may run on simulated time
+        self.clock = getattr(com, "clock", time.perf_counter)
+
+    async def write(self, data):
+        self.com.write(data)
+
+    async def read(self, size, timeout):
+        if self.com.timeout != timeout:
+            self.com.timeout = timeout
+        return self.com.read(size)
+
+    def read_ready(self, size):
+        """ Up to size bytes already received, without waiting """
+        n = min(size, self.com.in_waiting)
+        if n == 0:
+            return b''
+        return self.com.read(n)
+
+    def flush_input(self):
+        self.com.flushInput()
+
+    def close(self):
+        self.com.close()
+
+
+class FdTransport(object):
+    """ Transport on a serial port with a file descriptor, set to non-blocking
+    and watched by the event loop. Received bytes are buffered until read. """
+
+    def __init__(self, com, loop):
+        self.com = com
+        self.fd = com.fileno()
+        self.loop = loop
+        self._rx = bytearray()
+        self._want = 0
+        self._waiter = None
+        self._open = True
+        self.clock = loop.time
+        os.set_blocking(self.fd, False)
+        loop.add_reader(self.fd, self._readable)
+
+    def _readable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            # The other end is gone (EIO on a closed pty)
+            data = b''
+        if len(data) == 0:
+            self._open = False
+            self.loop.remove_reader(self.fd)
+        self._rx += data
+        if self._waiter is not None and not self._waiter.done() and (len(self._rx) >= self._want or not self._open):
+            self._waiter.set_result(None)
+
+    async def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            try:
+                n = os.write(self.fd, view)
+            except BlockingIOError:
+                n = 0
+            if n == 0:
+                writable = self.loop.create_future()
+                self.loop.add_writer(self.fd, lambda: writable.done() or writable.set_result(None))
+                try:
+                    await writable
+                finally:
+                    self.loop.remove_writer(self.fd)
+            view = view[n:]
+
+    async def read(self, size, timeout):
+        if len(self._rx) < size and self._open:
+            self._want = size
+            self._waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self._waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self._waiter = None
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def read_ready(self, size):
+        """ Up to size bytes already received, without waiting """
+        data = bytes(self._rx[:size])
+        del self._rx[:size]
+        return data
+
+    def flush_input(self):
+        self.com.flushInput()
+        del self._rx[:]
+
+    def close(self):
+        if self._open:
+            self._open = False
+            self.loop.remove_reader(self.fd)
+        self.com.close()
+
+
+def transport_for(com, loop):
+    """ FdTransport for com if the event loop can watch its file descriptor,
+    else BlockingTransport """
+    if os.name == 'posix' and hasattr(com, 'fileno'):
+        return FdTransport(com, loop)
+    return BlockingTransport(com)
+
+
+class AsyncSB01(object):
+    """ The bootloader commands as coroutines """
+
+    # Longest seconds to wait for the response, by command. Used until the
+    # round-trip time of the command has been measured.
+    TIMEOUTS = {
+        "erase": 1.0,
+        "adr": 0.5,
+        "data": 0.5,
+        "read": 0.5,
+        "crc": 0.5,
+        "rev": 0.5,
+        "drain": 0.5,
+    }
+
+    # Shortest timeout found from the round-trip times. The bootloader can
+    # not receive while erasing, so an erase is given the worst case erase
+    # time before it is sent again.
+    MIN_TIMEOUT = 0.05
+    MIN_TIMEOUTS = {
+        "erase": 0.5,
+    }
+
+    def __init__(self, transport, profile=SB01):
+        self.transport = transport
+        self.profile = profile
+        self.timeouts = dict(self.TIMEOUTS)
+        self.adaptive = True
+        self.rtt = {}
+        self.current_address = 0
+        self.frames_per_command = 1
+        # Most frames per data command whatever the revision, and if a
+        # command with more than one frame has been acked
+        self.max_frames = len(DATA_CMDS)
+        self.multi_frame_acked = False
+        self.metrics = None
+        # Set when a command has not been answered right, reads are then
+        # not pipelined any more
+        self.lossy = False
+
+    @classmethod
+    async def open(cls, port_name, baudrate=DEFAULT_BAUDRATE):
+        """ Open the bootloader on port_name, with the running event loop """
+        com = serial.Serial(port_name, baudrate=baudrate, timeout=0)
+        com.flushInput()
+        return cls(transport_for(com, asyncio.get_running_loop()))
+
+    def close(self):
+        self.transport.close()
+
+    def _timeout(self, command, timeout):
+        """ timeout if it is given, else srtt + 4 * rttvar for command like
+        in TCP, limited by timeouts[command] and MIN_TIMEOUTS """
+        if timeout is not None:
+            return timeout
+        if not self.adaptive or command not in self.rtt:
+            return self.timeouts[command]
+        srtt, rttvar = self.rtt[command]
+        # Rounded up to 10 ms, so a serial port is not reconfigured for
+        # every read
+        return min(self.timeouts[command], max(self.MIN_TIMEOUTS.get(command, self.MIN_TIMEOUT),
+                                               math.ceil((srtt + 4 * rttvar) * 100) / 100))
+
+    def _observe(self, command, seconds, ok):
+        """ Update the round-trip time of command with a response after
+        seconds. A timeout (ok False) doubles it. """
+        if not ok:
+            if command in self.rtt:
+                srtt, rttvar = self.rtt[command]
+                self.rtt[command] = (min(2 * srtt, self.timeouts[command]), rttvar)
+        elif command not in self.rtt:
+            self.rtt[command] = (seconds, seconds / 2)
+        else:
+            srtt, rttvar = self.rtt[command]
+            rttvar = 0.75 * rttvar + 0.25 * abs(seconds - srtt)
+            self.rtt[command] = (0.875 * srtt + 0.125 * seconds, rttvar)
+
+    def _now(self):
+        return self.transport.clock()
+
+    def _record(self, command, start, sent, resp, size):
+        """ Account for the response to command sent at start """
+        seconds = self.transport.clock() - start
+        self._observe(command, seconds, len(resp) == size)
+        if self.metrics is not None:
+            self.metrics.record(command, seconds, sent, len(resp), timeout=len(resp) < size,
+                                error=size == 1 and len(resp) == 1 and resp[0] != OK_RESP)
+
+    def _retry(self, command):
+        if self.metrics is not None:
+            self.metrics.retry(command)
+
+    async def _command(self, command, frame, size, timeout):
+        """ Send frame and return the response of size bytes, shorter if it
+        times out """
+        start = self._now()
+        await self.transport.write(frame)
+        resp = await self.transport.read(size, self._timeout(command, timeout))
+        self._record(command, start, len(frame), resp, size)
+        return resp
+
+    async def erase(self, a, timeout=None, retries=5):
+        self.transport.flush_input()
+        frame = bytes([ERASE_CMD, a & 0xFF, (a >> 8) & 0xFF, (a >> 16) & 0xFF, (a >> 24) & 0xFF])
+        for attempt in range(retries + 1):
+            resp = await self._command("erase", frame, 1, timeout)
+            if resp == bytes([OK_RESP]):
+                return
+            self._retry("erase")
+            await self.drain(self._timeout("erase", timeout))
+        raise Exception("Erase 0x%X failed, got %s" % (a, str(resp)))
+
+    async def write6(self, d0, d1, d2, d3, d4, d5, timeout=None, retries=5):
+        frame = bytes([DATA_CMD1, d0, d1, d2, d3, d4, d5])
+        for attempt in range(retries + 1):
+            resp = await self._command("data", frame, 1, timeout)
+            if resp == bytes([OK_RESP]):
+                self.current_address = self.current_address + 4
+                return
+            self._retry("data")
+            await self.drain(self._timeout("data", timeout))
+            await self.set_adr(self.current_address)
+        raise Exception("Write data failed, adr = {:04X}".format(self.current_address))
+
+    async def write_frames(self, a, frames, window=4, retries=5, progress=None, timeout=None):
+        """ Write a sequence of 6 byte frames starting at word address a.
+        Up to window frames are sent before waiting for the acks. A negative
+        or missing ack rewinds to the last confirmed address and resends
+        from there, giving up after retries failures in a row. progress is
+        called with the address after the last frame acked. Returns the
+        number of resends. """
+        on_ack = None if progress is None else lambda n: progress(a + 4 * n)
+        return await self._write_stream(self._stream([(None, [(a, frames)])], self.frames_per_command), window,
+                                        retries, on_ack, timeout)
+
+    async def write_pages(self, plan, window=4, retries=5, progress=None, on_page=None):
+        """ Erase and write pages. plan is a list of (page, runs), where runs
+        are the (address, frames) to write in the page after it is erased.
+        The commands are pipelined like in write_frames(). An erase is sent
+        right behind the frames for the page before, but nothing is sent
+        after it until it is acked, as the bootloader can not receive while
+        erasing. The same goes for an address command, so no frame can be
+        written at the old address if it is rejected. progress is called
+        with the number of frames written. Up to frames_per_command frames
+        go in each data command. on_page is called with each page when all
+        its commands are acked. If the first command with more than one
+        frame is not acked, frames_per_command is set to 1 and the rest is
+        sent one frame per command. Returns the number of resends. """
+        return await self._write_stream(self._stream(plan, self.frames_per_command), window, retries, progress,
+                                        on_page=on_page)
+
+    @staticmethod
+    def _stream(plan, per_command=1):
+        """ All the commands for plan built into one buffer, with up to
+        per_command frames in each data command. A page of None is not
+        erased. Returns the buffer, a list of (command, address, offset in
+        the buffer) ending with (None, 0, length of buffer), and a list of
+        (index after the last command, page) for the pages. """
+        size = 0
+        for page, runs in plan:
+            size += (0 if page is None else 5) + \
+                sum(5 + 6 * len(frames) + (len(frames) + per_command - 1) // per_command for adr, frames in runs)
+        buf = bytearray(size)
+        commands = []
+        pages = []
+        pos = 0
+        for page, runs in plan:
+            if page is not None:
+                buf[pos:pos + 5] = bytes([ERASE_CMD]) + page.to_bytes(4, 'little')
+                commands.append((ERASE_CMD, page, pos))
+                pos += 5
+            for adr, frames in runs:
+                buf[pos:pos + 5] = bytes([ADR_CMD]) + adr.to_bytes(4, 'little')
+                commands.append((ADR_CMD, adr, pos))
+                pos += 5
+                # Interleave the command byte and the data bytes of each
+                # full command with one slice assignment for each column
+                data = b"".join(frames)
+                q, r = divmod(len(frames), per_command)
+                cmd = DATA_CMDS[per_command - 1]
+                stride = 6 * per_command + 1
+                buf[pos:pos + stride * q:stride] = bytes([cmd]) * q
+                for j in range(stride - 1):
+                    buf[pos + 1 + j:pos + stride * q:stride] = data[j:(stride - 1) * q:stride - 1]
+                commands += [(cmd, adr + 4 * per_command * i, pos + stride * i) for i in range(q)]
+                pos += stride * q
+                if r > 0:
+                    buf[pos] = DATA_CMDS[r - 1]
+                    buf[pos + 1:pos + 1 + 6 * r] = data[(stride - 1) * q:]
+                    commands.append((DATA_CMDS[r - 1], adr + 4 * per_command * q, pos))
+                    pos += 6 * r + 1
+            if page is not None:
+                pages.append((len(commands), page))
+        commands.append((None, 0, pos))
+        return buf, commands, pages
+
+    @staticmethod
+    def _single_frames(stream, start):
+        """ The commands of a stream from _stream() from index start, with
+        each data command split into one DATA_CMD1 command per frame """
+        buf, commands, pages = stream
+        out = bytearray()
+        single = []
+        index = {}
+        for i in range(start, len(commands) - 1):
+            index[i] = len(single)
+            cmd, adr, offset = commands[i]
+            end = commands[i + 1][2]
+            if cmd in DATA_CMDS:
+                for j in range(offset + 1, end, 6):
+                    single.append((DATA_CMD1, adr + 4 * ((j - offset - 1) // 6), len(out)))
+                    out += bytes([DATA_CMD1]) + buf[j:j + 6]
+            else:
+                single.append((cmd, adr, len(out)))
+                out += buf[offset:end]
+        index[len(commands) - 1] = len(single)
+        single.append((None, 0, len(out)))
+        return out, single, [(index[i], page) for i, page in pages if i > start]
+
+    async def _write_stream(self, stream, window, retries, progress, timeout=None, on_page=None):
+        """ Send the commands of a stream from _stream(). The window is
+        refilled when a quarter of it is free, with all the commands it has room
+        for in one write straight from the buffer. All the acks already
+        received are taken at once. """
+        buf, commands, pages = stream
+        view = memoryview(buf)
+        count = len(commands) - 1
+        done = 0
+        acked = 0
+        sent = 0
+        written = 0
+        errors = 0
+        failed = 0
+        sent_at = [0.0] * count
+        self.transport.flush_input()
+        while acked < count:
+            end = sent
+            if sent - acked <= window - max(1, window // 4):
+                while end < count and end - acked < window and \
+                        not (end > acked and commands[end - 1][0] in (ERASE_CMD, ADR_CMD)):
+                    end = end + 1
+            if end > sent:
+                now = self._now()
+                for i in range(sent, end):
+                    sent_at[i] = now
+                await self.transport.write(view[commands[sent][2]:commands[end][2]])
+                sent = end
+            resp = await self.transport.read(1, self._timeout(_NAMES[commands[acked][0]], timeout))
+            if resp == _OK:
+                resp += self.transport.read_ready(sent - acked - 1)
+            ok = len(resp) > 0
+            for r in resp:
+                cmd, adr, offset = commands[acked]
+                if r != OK_RESP:
+                    ok = False
+                    resp = bytes([r])
+                    break
+                self._record(_NAMES[cmd], sent_at[acked], commands[acked + 1][2] - offset, _OK, 1)
+                acked = acked + 1
+                if cmd in DATA_CMDS:
+                    n = (commands[acked][2] - offset) // 6
+                    if n > 1:
+                        self.multi_frame_acked = True
+                    self.current_address = adr + 4 * n
+                    written = written + n
+                    if progress is not None:
+                        progress(written)
+                while done < len(pages) and pages[done][0] <= acked:
+                    if on_page is not None:
+                        on_page(pages[done][1])
+                    done = done + 1
+            if ok:
+                failed = 0
+                continue
+            cmd, adr, offset = commands[acked]
+            self._record(_NAMES[cmd], sent_at[acked], commands[acked + 1][2] - offset, resp, 1)
+            self.lossy = True
+            errors = errors + 1
+            failed = failed + 1
+            if failed > retries:
+                if cmd == ERASE_CMD:
+                    raise Exception("Erase 0x%X failed, got %s" % (adr, str(resp)))
+                if cmd == ADR_CMD:
+                    raise Exception("Set address 0x%X failed" % adr)
+                raise Exception("Write data failed, adr = {:04X}".format(adr))
+            self._retry(_NAMES[cmd])
+            # Let the commands in flight complete and discard their acks,
+            # then resend from the command that failed. A data frame needs
+            # its address set first.
+            await self.drain(max(self._timeout(_NAMES[c[0]], timeout) for c in commands[acked:sent]))
+            if cmd in DATA_CMDS and cmd != DATA_CMD1 and not self.multi_frame_acked:
+                # The bootloader may not know the multi frame commands
+                self.frames_per_command = 1
+                buf, commands, pages = self._single_frames((buf, commands, pages), acked)
+                view = memoryview(buf)
+                count = len(commands) - 1
+                sent_at = [0.0] * count
+                acked = 0
+                sent = 0
+                done = 0
+            while cmd in DATA_CMDS and not await self.set_adr(adr):
+                failed = failed + 1
+                if failed > retries:
+                    await self._adr_failed(adr)
+                await self.drain(self._timeout("adr", None))
+            sent = acked
+        return errors
+
+    async def drain(self, timeout=None):
+        """ Read and discard input until the line is quiet """
+        timeout = self._timeout("drain", timeout)
+        while len(await self.transport.read(64, timeout)) > 0:
+            pass
+
+    async def exit_bootloader(self):
+        self.transport.flush_input()
+        await self.transport.write(bytes([AUX_CMD, START_CMD]))
+
+    async def get_crc(self, timeout=None):
+        """ Returns the CRC of the application flash, or None. The byte
+        order is the one of the device profile. """
+        self.transport.flush_input()
+        resp = await self._command("crc", bytes([AUX_CMD, CRC_CMD]), 2, timeout)
+        if len(resp) != 2:
+            return None
+        return self.profile.crc_from_bytes(resp)
+
+    async def get_rev(self, timeout=None):
+        """ Returns the bootloader revision as 2 bytes, empty if there is
+        no response. frames_per_command is set to the most the revision,
+        the device profile and max_frames allow. """
+        self.transport.flush_input()
+        resp = await self._command("rev", bytes([AUX_CMD, REV_CMD]), 2, timeout)
+        if len(resp) == 2:
+            self.frames_per_command = min(self.max_frames, self.profile.frames_per_command(resp))
+        return resp
+
+    async def set_adr(self, a, timeout=None):
+        self.current_address = a
+        resp = await self._command("adr", bytes([ADR_CMD, a & 0xFF, (a >> 8) & 0xFF, (a >> 16) & 0xFF,
+                                                 (a >> 24) & 0xFF]), 1, timeout)
+        return resp == b'\n'
+
+    async def _adr_failed(self, a):
+        """ Raise the reason set_adr(a) was not answered. A bootloader that
+        does not answer get_rev either has started the application. """
+        await self.drain(self._timeout("adr", None))
+        if len(await self.get_rev()) != 2:
+            raise Exception("Set address 0x%X failed, the bootloader exited" % a)
+        raise Exception("Set address 0x%X failed" % a)
+
+    async def read_word(self, timeout=None):
+        resp = await self._command("read", bytes([AUX_CMD, READ_WORD]), 4, timeout)
+        self.current_address = self.current_address + 2
+        return resp
+
+    async def read_dword(self, timeout=None):
+        self.current_address = self.current_address + 4
+        return await self._command("read", bytes([AUX_CMD, READ_DWORD]), 8, timeout)
+
+    async def read_flash(self, a, words, window=8, retries=5, timeout=None):
+        """ Read words from word address a. Up to window READ_DWORD requests
+        are sent before waiting for the data. A missing response rewinds to
+        the last address received and requests from there. Returns the data
+        in hex file layout, 4 bytes per instruction. A response where the
+        phantom bytes differ from the first one must have lost a byte, and
+        is requested again. If a byte of a request is lost, the next request
+        can complete AUX_CMD START_CMD and start the application, so after
+        the first missing or wrong response to any command (see lossy) the
+        reads are one request at a time, each sent when the line is quiet.
+        Setting the address and reading give up after retries failures in a
+        row. """
+        count = (words + 3) // 4
+        request = bytes([AUX_CMD, READ_DWORD])
+        data = bytearray()
+        received = 0
+        sent = 0
+        failed = 0
+        phantom = None
+        sent_at = [0.0] * count
+        if self.lossy:
+            window = 1
+        while not await self.set_adr(a):
+            failed = failed + 1
+            if failed > retries:
+                await self._adr_failed(a)
+            await self.drain(self._timeout("adr", None))
+        failed = 0
+        while received < count:
+            n = min(count, received + window) - sent
+            if n > 0:
+                sent_at[sent:sent + n] = [self._now()] * n
+                await self.transport.write(request * n)
+                sent = sent + n
+            resp = await self.transport.read(8, self._timeout("read", timeout))
+            self._record("read", sent_at[received], 2, resp, 8)
+            if len(resp) == 8 and phantom is None:
+                phantom = resp[3]
+            if len(resp) == 8 and resp[3] == phantom and resp[7] == phantom:
+                data += resp
+                received = received + 1
+                failed = 0
+                continue
+            failed = failed + 1
+            if failed > retries:
+                raise Exception("Read flash 0x%X failed" % (a + 4 * received))
+            self._retry("read")
+            self.lossy = True
+            window = 1
+            await self.drain(self._timeout("read", timeout))
+            while not await self.set_adr(a + 4 * received):
+                failed = failed + 1
+                if failed > retries:
+                    await self._adr_failed(a + 4 * received)
+                await self.drain(self._timeout("adr", None))
+            sent = received
+        self.current_address = a + 4 * count
+        return bytes(data[:words * 2])
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        benchmark.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Benchmarks for the hex file parser, the frame preparation and the full
+# download, using synthetic hex files and the emulator:
+#
+#     python benchmark.py --output=before.json
+#     python benchmark.py --baseline=before.json
+#
+# The download runs against an SB01Emulator on simulated time, so the line
+# time ("line" seconds) is exact and only depends on the protocol, while
+# "seconds" is the time the host used. With --pty it runs against a
+# PtyEmulator in real time instead. Times are the best of --repeat runs.
+#
+# The downloads with error responses, lost acks and bytes lost on the line
+# are a regression check of the recovery: the run fails if the image is
+# not verified, or with lost bytes if the bootloader exits or a failed
+# verify is not reported.
+
+import getopt
+import io
+import json
+import platform
+import random
+import sys
+import time
+import downloader
+import emulator
+import intelhex
+from aiosb01 import AsyncSB01
+from flashimage import FlashImage
+from profiles import SB01, profile_argument
+
+FORMAT_VERSION = 1
+
+
+def parse_cases(profile=SB01):
+    """ (bytes, part of the 256 byte blocks left out, record length) of the
+    hex files parsed. The first two, of the flash size of the device
+    profile, are also downloaded. """
+    size = profile.flash_end * 2
+    return [
+        (size, 0.0, 16),
+        (size, 0.5, 16),
+        (size, 0.0, 64),
+        (0x40000, 0.2, 32),
+    ]
+
+
+# (name, error response, lost ack and lost byte probability) of the
+# downloads on a bad line
+FAULT_CASES = [
+    ("errors", 0.01, 0.0, 0.0),
+    ("drops", 0.0, 0.01, 0.0),
+    ("loss", 0.0, 0.0, 0.0001),
+]
+
+
+def synthetic_hex(size, sparsity=0.0, record_length=16, seed=1, start=0):
+    """ Intel HEX text for size bytes of random instructions from byte
+    address start, in hex file layout with zero phantom bytes. A part
+    sparsity of the 256 byte blocks is left out. Files above 64K get
+    extended linear address records. """
+    rnd = random.Random(seed)
+    out = io.StringIO()
+    writer = intelhex.IntelHexWriter(out, record_length)
+    for a in range(start, start + size, 256):
+        if rnd.random() < sparsity:
+            continue
+        n = min(256, start + size - a)
+        data = bytearray(rnd.getrandbits(8) for i in range(n))
+        data[3::4] = bytes(len(data[3::4]))
+        writer.write(a, data)
+    writer.close()
+    return out.getvalue()
+
+
+def best_of(repeat, function):
+    """ The shortest time of repeat calls to function """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+
+def bench_parse(size, sparsity, record_length, repeat=5, profile=SB01):
+    """ Time loading a synthetic hex file, byte and slice lookups, and
+    preparing the frames to send to a device of profile """
+    text = synthetic_hex(size, sparsity, record_length)
+    hex = intelhex.IntelHex(io.StringIO(text))
+    rnd = random.Random(2)
+    addresses = [rnd.randrange(size) for i in range(10000)]
+
+    def lookup():
+        for a in addresses:
+            hex[a]
+        for a in addresses[:100]:
+            hex[a:a + 64]
+
+    result = {
+        "records": text.count("\n"),
+        "load": best_of(repeat, lambda: intelhex.IntelHex(io.StringIO(text))),
+        "load_lines": best_of(repeat, lambda: intelhex.IntelHex(io.StringIO(text), bulk=False)),
+        "lookup": best_of(repeat, lookup),
+    }
+    if size <= profile.flash_end * 2:
+        def prepare():
+            image = FlashImage.from_hex(hex, profile)
+            AsyncSB01._stream(image.page_plan(image.pages()), 4)
+
+        result["prepare"] = best_of(repeat, prepare)
+    return result
+
+
+def bench_download(image, baudrate, latency, revision, full_verify=False, pty=False, repeat=1, error_rate=0.0,
+                   drop_rate=0.0, loss_rate=0.0):
+    """ Time programming and verifying image on an emulated bootloader
+    of the device profile of the image,
+    with the error, drop and loss rates of the emulator. Returns the host
+    time, the line time and the line throughput. Raises an exception if
+    the download fails. With lost bytes a failed verify is allowed, if it
+    is reported and the bootloader still runs. """
+    best = None
+    for i in range(repeat):
+        device = emulator.SB01Device(image.profile, revision=revision, error_rate=error_rate, drop_rate=drop_rate,
+                                     seed=i)
+        if pty:
+            link = emulator.PtyEmulator(device, baudrate, latency, erase_time=0.025, loss_rate=loss_rate)
+            link.start()
+            board = downloader.SB01(link.port, baudrate=baudrate, profile=image.profile)
+            clock = time.perf_counter
+        else:
+            link = emulator.SB01Emulator(device, baudrate, latency, erase_time=0.025, realtime=False,
+                                         loss_rate=loss_rate)
+            board = downloader.SB01("emulator", com=link, profile=image.profile)
+            clock = link.clock
+        try:
+            board.get_rev(log=lambda msg: None)
+            start = time.perf_counter()
+            line_start = clock()
+            errors = downloader.program(board, image, window=8, full_verify=full_verify, log=lambda msg: None)
+            seconds = time.perf_counter() - start
+            line = clock() - line_start
+        finally:
+            board.close()
+            if pty:
+                link.stop()
+        verified = len(errors) == 0 and device.crc() == image.crc()
+        if device.started or (len(errors) == 0 and not verified) or (loss_rate == 0 and not verified):
+            raise Exception("Download failed at %d baud" % baudrate)
+        if best is None or seconds < best["seconds"]:
+            best = {"seconds": seconds, "line": line}
+    best["bytes_per_second"] = len(image.data) / best["line"]
+    return best
+
+
+def run(rates=(115200,), latency=0.004, repeat=5, pty=False, log=print, profile=SB01):
+    """ Run all the benchmarks for a device profile. Returns the results as
+    a dict """
+    results = {}
+    cases = parse_cases(profile)
+    for size, sparsity, record_length in cases:
+        name = "parse/%dk/sparse%d/rec%d" % (size // 1024, int(sparsity * 100), record_length)
+        results[name] = bench_parse(size, sparsity, record_length, repeat, profile)
+        log("%-40s %s" % (name, format_result(results[name])))
+    for size, sparsity, record_length in cases[:2]:
+        image = FlashImage.from_hex(intelhex.IntelHex(io.StringIO(synthetic_hex(size, sparsity, record_length))),
+                                    profile)
+        for baudrate in rates:
+            for revision in ((1, 0), (1, 1)):
+                for full_verify in (False, True):
+                    name = "download/sparse%d/%d/rev%d.%d%s" % (int(sparsity * 100), baudrate, revision[0],
+                                                                revision[1], "/verify" if full_verify else "")
+                    results[name] = bench_download(image, baudrate, latency, revision, full_verify, pty,
+                                                   1 if pty else min(repeat, 3))
+                    log("%-40s %s" % (name, format_result(results[name])))
+    image = FlashImage.from_hex(intelhex.IntelHex(io.StringIO(synthetic_hex(*cases[1]))), profile)
+    for fault, error_rate, drop_rate, loss_rate in FAULT_CASES:
+        for baudrate in rates:
+            name = "download/%s/%d" % (fault, baudrate)
+            results[name] = bench_download(image, baudrate, latency, (1, 1), False, pty, 1 if pty else min(repeat, 3),
+                                           error_rate, drop_rate, loss_rate)
+            log("%-40s %s" % (name, format_result(results[name])))
+    return {
+        "version": FORMAT_VERSION,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "device": profile.name,
+        "latency": latency,
+        "pty": pty,
+        "results": results,
+    }
+
+
+def format_result(result):
+    return "  ".join("%s=%.4g" % (key, value) for key, value in sorted(result.items()))
+
+
+def compare(results, baseline, tolerance=0.1, log=print):
+    """ Compare the times with a baseline. Returns the names of the times
+    more than tolerance slower than the baseline. """
+    slower = []
+    log("%-48s %10s %10s %7s" % ("Benchmark", "Baseline", "Now", "Ratio"))
+    for name in sorted(results["results"]):
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for key in ("load", "load_lines", "lookup", "prepare", "seconds", "line"):
+            if key not in results["results"][name] or key not in old or old[key] <= 0:
+                continue
+            new = results["results"][name][key]
+            ratio = new / old[key]
+            mark = ""
+            if ratio > 1 + tolerance:
+                mark = " slower"
+                slower.append(name + "/" + key)
+            elif ratio < 1 - tolerance:
+                mark = " faster"
+            log("%-48s %10.4g %10.4g %7.2f%s" % (name + "/" + key, old[key], new, ratio, mark))
+    return slower
+
+
+def main():
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], "ho:b:r:l:n:t:pe:",
+                                          ["help", "output=", "baseline=", "rates=", "latency=", "repeat=",
+                                           "tolerance=", "pty", "device="])
+    except getopt.error as err:
+        print(str(err))
+        sys.exit(2)
+    output = ""
+    baseline = ""
+    rates = [115200]
+    latency = 0.004
+    repeat = 5
+    tolerance = 0.1
+    pty = False
+    profile = SB01
+    for current_argument, current_value in arguments:
+        current_value = str.lstrip(current_value, '=:')
+        if current_argument in ("-o", "--output"):
+            output = current_value
+        elif current_argument in ("-b", "--baseline"):
+            baseline = current_value
+        elif current_argument in ("-r", "--rates"):
+            rates = [int(rate) for rate in current_value.split(",")]
+        elif current_argument in ("-l", "--latency"):
+            latency = float(current_value) / 1000
+        elif current_argument in ("-n", "--repeat"):
+            repeat = max(1, int(current_value))
+        elif current_argument in ("-t", "--tolerance"):
+            tolerance = float(current_value)
+        elif current_argument in ("-p", "--pty"):
+            pty = True
+        elif current_argument in ("-e", "--device"):
+            profile = profile_argument(current_value)
+        else:
+            print("The following arguments are valid:")
+            print("-h  --help           : Will show this help info")
+            print("-o  --output=<file>  : Write the results to a JSON file")
+            print("-b  --baseline=<file>: Compare with results written before, exit code 1 if slower")
+            print("-r  --rates=<list>   : Baud rates to download at, separated by comma (default 115200)")
+            print("-l  --latency=<ms>   : Turnaround time of the emulated bootloader in ms (default 4)")
+            print("-n  --repeat=<n>     : Runs of each benchmark, the best is used (default 5)")
+            print("-t  --tolerance=<p>  : Part a time may grow before it counts as slower (default 0.1)")
+            print("-p  --pty            : Download to an emulator on a pseudo terminal in real time")
+            print("-e  --device=<name>  : Device profile to benchmark (default SB01)")
+            sys.exit(0)
+    results = run(rates, latency, repeat, pty, profile=profile)
+    if output != "":
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if baseline != "":
+        with open(baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("device", SB01.name) != profile.name:
+            print("The baseline is for device %s" % baseline.get("device", SB01.name))
+            sys.exit(2)
+        if len(compare(results, baseline, tolerance)) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
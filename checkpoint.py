@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        checkpoint.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Journal of the pages written in a download, so an interrupted download
+# can be resumed with --resume instead of starting over. There is one
+# journal file for each port, holding the hash of the image being written
+# and the pages the bootloader has acked all commands for, in the order
+# they were written. The journal is removed when the download is verified.
+
+import hashlib
+import json
+import os
+import re
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".sb01-downloader", "checkpoints")
+
+
+def image_hash(image):
+    """ Hash of the flash contents of a FlashImage """
+    h = hashlib.sha256()
+    h.update(b"%s:%d:" % (image.profile.name.encode(), image.flash_end))
+    h.update(image.data)
+    return h.hexdigest()
+
+
+class Checkpoint(object):
+    """ The journal for the download of image to the board at port. With
+    resume set the pages of an earlier download of the same image to the
+    same port are loaded into pages, else the journal starts empty. Errors
+    writing the journal are ignored, the download can then just not be
+    resumed. """
+
+    def __init__(self, port, image, resume=False, directory=None):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.path = os.path.join(directory, re.sub(r"[^\w.-]", "_", port) + ".json")
+        self.port = port
+        self.image = image_hash(image)
+        self.pages = []
+        if resume:
+            self.pages = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                journal = json.load(f)
+        except (OSError, ValueError):
+            return []
+        if journal.get("image") != self.image:
+            return []
+        return list(journal.get("pages", []))
+
+    def record(self, page):
+        """ Add a page that has been written """
+        self.pages.append(page)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"port": self.port, "image": self.image, "pages": self.pages}, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError:
+            pass
+
+    def clear(self):
+        """ Forget the pages, when the download is done """
+        self.pages = []
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -4,6 +4,8 @@
 # Author:      Jan Kåre Vatne
 # Created:     11.06.2021
 # -------------------------------------------------------------------------------
+import asyncio
+import atexit
 import signal
 import time
 import sys
@@ -11,92 +13,133 @@ import serial
 import getopt
 import traceback
 import ports
+from ports import hotplug_listener, wait_for_bootloader
 import intelhex
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import glob
+from flashimage import FlashImage, strip_phantom, diff_ranges, used_ranges
+from imagecache import ImageCache
+from flashpackage import PackageImage, is_package
+from checkpoint import Checkpoint
+from metrics import Metrics, write_json, write_prometheus
+from aiosb01 import AsyncSB01, transport_for
+from protocol import AUX_CMD, START_CMD, DEFAULT_BAUDRATE, DATA_CMDS
+import profiles
 
-ERASE_CMD = 0x45
-ADR_CMD = 0x85
-DATA_CMD1 = 0xC7
-DATA_CMD2 = 0xCD
-DATA_CMD3 = 0xD3
-DATA_CMD4 = 0xD9
-AUX_CMD = 0x02
-CRC_CMD = 0x01
-START_CMD = 0x02
-REV_CMD = 0x03
-READ_WORD = 0x04
-READ_DWORD = 0x05
-OK_RESP = 0x0A
-ERR_RESP = 0xAA
-QUERY_CMD = 0x61
+# Boards with an open port, started by exit_gracefully() on ctrl-C
+open_boards = []
 
 
 class SB01(object):
-
-    def __init__(self, port_name):
-        self.com = serial.Serial(port_name, baudrate=19200)
+    """ Synchronous interface to the bootloader. The commands are the
+    AsyncSB01 coroutines, run on an event loop of its own. """
+
+    def __init__(self, port_name, com=None, baudrate=DEFAULT_BAUDRATE, metrics=None, profile=profiles.SB01,
+                 max_frames=None):
+        """ Open the bootloader on port_name. A serial-like object (for
+        example an emulator.SB01Emulator) can be given in com instead. The
+        commands are recorded in metrics if it is a metrics.Metrics.
+        profile is the profiles.DeviceProfile of the device. max_frames
+        limits the frames sent in one data command. """
+        if com is None:
+            com = serial.Serial(port_name, baudrate=baudrate)
+        self.com = com
         self.com.timeout = 0.5
         self.is_open = True
-        self.current_address = 0
         self.com.flushInput()
+        self.loop = asyncio.new_event_loop()
+        self.client = AsyncSB01(transport_for(com, self.loop), profile)
+        self.client.metrics = metrics
+        if max_frames is not None:
+            self.client.max_frames = max_frames
+
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
+
+    @property
+    def current_address(self):
+        return self.client.current_address
+
+    def close(self):
+        self.client.close()
+        self.loop.close()
+        self.is_open = False
+
+    def auto_baudrate(self, rates=None, timeout=0.1):
+        """ Find the fastest of rates where the bootloader answers get_rev,
+        trying each rate twice. The default rates are the ones of the device
+        profile. The port is left at that rate, or at the rate it had if none
+        answers. Returns the rate found, or None. """
+        if rates is None:
+            rates = self.client.profile.baudrates
+        start = self.com.baudrate
+        for rate in rates:
+            self.com.baudrate = rate
+            for attempt in range(2):
+                # Bytes sent at another rate may have left garbage on the line
+                self._run(self.client.drain(timeout / 2))
+                if len(self._run(self.client.get_rev(timeout))) == 2:
+                    return rate
+        self.com.baudrate = start
+        return None
 
     def erase(self, a):
-        self.com.flushInput()
-        self.com.write(bytes([ERASE_CMD, a & 0xFF, (a >> 8) & 0xFF, (a >> 16) & 0xFF, (a >> 24) & 0xFF]))
-        resp = self.com.read(1)
-        if resp[0] != OK_RESP:
-            raise Exception("Erase 0x%X failed, got %s" % (a, str(resp)))
+        self._run(self.client.erase(a))
 
     def write6(self, d0, d1, d2, d3, d4, d5):
-        self.com.write(bytes([DATA_CMD1, d0, d1, d2, d3, d4, d5]))
-        resp = self.com.read(1)
-        if resp[0] != OK_RESP:
-            raise Exception("Write data failed, adr = {:04X}".format(self.current_address))
-        if len(resp) > 3:
-            print("write() returned current_address = {:02X} {:02X} {:02X}".format(resp[1], resp[2], resp[3]))
-        self.current_address = self.current_address + 4
+        self._run(self.client.write6(d0, d1, d2, d3, d4, d5))
+
+    def write_frames(self, a, frames, window=4, retries=5, progress=None):
+        """ Write a sequence of 6 byte frames starting at word address a,
+        see AsyncSB01.write_frames(). Returns the number of resends. """
+        return self._run(self.client.write_frames(a, frames, window, retries, progress))
+
+    def write_pages(self, plan, window=4, retries=5, progress=None, on_page=None):
+        """ Erase and write pages, see AsyncSB01.write_pages(). Returns the
+        number of resends. """
+        return self._run(self.client.write_pages(plan, window, retries, progress, on_page))
+
+    def drain(self):
+        """ Read and discard input until the line is quiet """
+        self._run(self.client.drain())
 
     def exit_bootloader(self):
+        # Written directly on the port, so it also works from the ctrl-C
+        # handler while a command is running on the event loop.
         self.com.flushInput()
         self.com.write(bytes([AUX_CMD, START_CMD]))
 
     def get_crc(self):
-        self.com.flushInput()
-        self.com.write(bytes([AUX_CMD, CRC_CMD]))
-        resp = self.com.read(2)
-        if len(resp) != 2:
+        """ Returns the CRC of the application flash, or None """
+        crc = self._run(self.client.get_crc())
+        if crc is None:
             print("Get crc failed")
-        else:
-            print("Crc=%x" % resp)
+        return crc
 
-    def get_rev(self):
-        self.com.flushInput()
-        self.com.write(bytes([AUX_CMD, REV_CMD]))
-        resp = self.com.read(2)
+    def get_rev(self, log=print):
+        """ Returns the bootloader revision as 2 bytes, empty if there is no
+        response. The result is given to log. """
+        resp = self._run(self.client.get_rev())
         if len(resp) != 2:
-            print("Get revision failed")
+            log("Get revision failed")
         else:
-            print("Bootloader revision %d.%d" % (resp[0], resp[1]))
+            log("Bootloader revision %d.%d" % (resp[0], resp[1]))
         return resp
 
     def set_adr(self, a):
-        self.current_address = a
-        self.com.write(bytes([ADR_CMD, a & 0xFF, (a >> 8) & 0xFF, (a >> 16) & 0xFF, (a >> 24) & 0xFF]))
-        resp = self.com.read(1)
-        return resp == b'\n'
+        return self._run(self.client.set_adr(a))
 
     def read_word(self):
-        self.com.write(bytes([AUX_CMD, READ_WORD]))
-        resp = self.com.read(4)
-        self.current_address = self.current_address + 2
-        return resp
+        return self._run(self.client.read_word())
 
     def read_dword(self):
-        self.current_address = self.current_address + 4
-        self.com.write(bytes([AUX_CMD, READ_DWORD]))
-        resp = self.com.read(8)
-        return resp
+        return self._run(self.client.read_dword())
+
+    def read_flash(self, a, words, window=8, retries=5):
+        """ Read words from word address a, see AsyncSB01.read_flash().
+        Returns the data in hex file layout, 4 bytes per instruction. """
+        return self._run(self.client.read_flash(a, words, window, retries))
 
     def verify(self, data):
         r = self.read_word()
@@ -108,8 +151,328 @@ class SB01(object):
             sys.exit(1)
 
 
-def exit_gracefully():
-    board.exit_bootloader()
+def load_image(filename, use_cache=True, profile=profiles.SB01):
+    """ Returns the FlashImage for a hex file or an image package, for the
+    device profile """
+    if is_package(filename):
+        return PackageImage(filename, profile)
+    if use_cache:
+        return ImageCache().load(filename, profile)
+    return FlashImage.from_hex(intelhex.IntelHex(filename), profile)
+
+
+def verify_crc(board, image, full=False, window=8, log=print):
+    """ Compare the device CRC with the image. If they differ, or full is
+    set, the flash is read back to find the ranges that are wrong. Returns
+    the list of (first, end) word address ranges that differ from image. """
+    crc = board.get_crc()
+    expected = image.crc()
+    if crc == expected and not full:
+        log("Verify ok, CRC=0x%04X" % crc)
+        return []
+    if crc is not None and crc != expected:
+        log("CRC differs, card 0x%04X, hex file 0x%04X" % (crc, expected))
+    log("Reading back flash")
+    ranges = verify_flash(board, image, window=window)
+    if len(ranges) == 0:
+        log("Verify ok")
+    else:
+        log("Verify failed at " + ", ".join("0x%04X-0x%04X" % (a, b - 1) for a, b in ranges))
+    return ranges
+
+
+def verify_flash(board, image, start=None, end=None, window=8):
+    """ Read back the flash from word address start to end and compare it
+    with the image. The default is from app_start to the flash end of the
+    image profile. Returns the list of (first, end) word address ranges
+    that differ, empty if all is ok """
+    if start is None:
+        start = image.profile.app_start
+    if end is None:
+        end = image.flash_end
+    got = strip_phantom(board.read_flash(start, end - start, window))
+    return diff_ranges(image.instructions(start, end), got, start)
+
+
+def range_pages(ranges, page_size=profiles.SB01.page_size):
+    """ Returns the pages touched by a list of word address ranges """
+    pages = set()
+    for first, end in ranges:
+        pages.update(range(first - first % page_size, end, page_size))
+    return sorted(pages)
+
+
+def changed_pages(board, image, window=8):
+    """ Read back the flash and return the pages that differ from the image """
+    return range_pages(verify_flash(board, image, window=window), image.profile.page_size)
+
+
+def dump_flash(board, filename, start=0x0000, end=None, window=8, record_length=16, profile=profiles.SB01):
+    """ Read the flash from word address start to end, default the flash
+    end of profile, into filename. A name ending with .bin gets the raw data
+    in hex file layout, else an Intel HEX file is written without the blank
+    instructions. The flash is read and written a page at a time. """
+    if end is None:
+        end = profile.flash_end
+    page_size = profile.page_size
+    binary = filename.lower().endswith(".bin")
+    with open(filename, "wb" if binary else "w") as f:
+        writer = None if binary else intelhex.IntelHexWriter(f, record_length)
+        for a in range(start, end, page_size):
+            data = board.read_flash(a, min(page_size, end - a), window)
+            if binary:
+                f.write(data)
+                continue
+            for first, last in used_ranges(data):
+                writer.write(a * 2 + first, data[first:last])
+        if writer is not None:
+            writer.close()
+
+
+class ProgressReporter(object):
+    """ Called with the number of frames written, calls report with the
+    percentage of total when it has changed, at most every interval
+    seconds. 100% is always reported. """
+
+    def __init__(self, report, total, interval=0.1):
+        self.report = report
+        self.total = total
+        self.interval = interval
+        self.percent = None
+        self.reported_at = 0.0
+
+    def __call__(self, n):
+        percent = 100 * n // self.total
+        if percent == self.percent:
+            return
+        now = time.time()
+        if percent < 100 and now - self.reported_at < self.interval:
+            return
+        self.percent = percent
+        self.reported_at = now
+        self.report(percent)
+
+
+def program(board, image, window=4, diff=False, base=None, full_verify=False, log=print, progress=None, repair=1,
+            checkpoint=None):
+    """ Erase, write and verify the image. Only the pages where the image
+    has data are erased, the other pages are erased afterwards if the CRC
+    shows the card holds old data. With diff set the flash is read back and only
+    the pages that differ are programmed, with a base image only the pages
+    where image and base differ. progress is called with the percentage of
+    frames written. The pages that fail verify are erased and written again
+    up to repair times. Each page written is recorded in the Checkpoint
+    checkpoint. If it holds pages from an interrupted download, the last of
+    them is read back, and if it is right the pages are not written again.
+    Returns the list of (first, end) word address ranges that failed
+    verify. """
+    profile = image.profile
+    crc = None
+    unknown = []
+    if base is not None or diff:
+        crc = board.get_crc()
+    if crc is not None and crc == image.crc():
+        log("The card already holds this hex file")
+        pages = []
+    elif base is not None:
+        if crc == base.crc():
+            pages = image.diff_pages(base)
+        else:
+            log("The card does not hold the base hex file, reading back flash")
+            pages = changed_pages(board, image, window)
+    elif diff:
+        pages = changed_pages(board, image, window)
+    else:
+        pages = image.pages()
+        unknown = [p for p in profile.pages if p not in pages]
+    if checkpoint is not None and len(checkpoint.pages) > 0 and len(pages) > 0:
+        last = checkpoint.pages[-1]
+        if len(verify_flash(board, image, max(last, profile.app_start), last + profile.page_size, window)) == 0:
+            log("Resuming after page 0x%04X" % last)
+            pages = [p for p in pages if p not in checkpoint.pages]
+        else:
+            log("Page 0x%04X is not as written before, starting over" % last)
+            checkpoint.clear()
+    log("Erasing and writing %d of %d pages: %s" % (len(pages), len(profile.pages),
+                                                    " ".join("0x%04X" % p for p in pages)))
+
+    log("Last used address in hex file is 0x%X" % image.last_adr())
+    # Write 6 bytes at a time, i.e. 4 words or 2 instructions a 3 bytes.
+    # starting at word 4 (instruction 2) which is interrupt vector
+    plan = image.page_plan(pages)
+    total = sum(len(run[1]) for page, runs in plan for run in runs)
+    log("Writing %d frames in %d runs" % (total, sum(len(runs) for page, runs in plan)))
+    frame_progress = None
+    if progress is not None and total > 0:
+        frame_progress = ProgressReporter(progress, total)
+    resends = board.write_pages(plan, window, progress=frame_progress,
+                                on_page=None if checkpoint is None else checkpoint.record)
+    if progress is not None and total == 0:
+        # The last ack reports 100% when there are frames
+        progress(100)
+    if resends > 0:
+        log("%d commands had to be resent" % resends)
+    if len(unknown) > 0 and board.get_crc() != image.crc():
+        # Erasing is much faster than reading back to find the pages with
+        # old data
+        log("CRC differs, erasing the other %d pages" % len(unknown))
+        for page in unknown:
+            board.erase(page)
+    errors = verify_crc(board, image, full_verify, window, log)
+    for attempt in range(repair):
+        if len(errors) == 0:
+            break
+        pages = range_pages(errors, profile.page_size)
+        log("Writing %d pages again: %s" % (len(pages), " ".join("0x%04X" % p for p in pages)))
+        board.write_pages(image.page_plan(pages), window)
+        errors = verify_crc(board, image, full_verify, window, log)
+    if checkpoint is not None:
+        checkpoint.clear()
+    return errors
+
+
+def board_metrics(metrics, port):
+    """ The Metrics for port in the dict metrics, None if metrics is None """
+    if metrics is None:
+        return None
+    return metrics.setdefault(port, Metrics(port))
+
+
+def program_port(port, image, status, baudrate=DEFAULT_BAUDRATE, auto_baud=False, metrics=None, resume=False,
+                 max_frames=None, **options):
+    """ Program the image on the card at port, for gang programming.
+    status[port] is updated with the progress. With auto_baud set the
+    fastest rate the bootloader answers at is used, else baudrate. If
+    metrics is a dict, the commands are recorded in metrics[port]. With
+    resume set an interrupted download to the port is continued. Returns
+    (port, result, seconds) where result is "ok" or the reason it failed. """
+    start_time = time.time()
+    board = None
+    try:
+        board = SB01(port, baudrate=baudrate, metrics=board_metrics(metrics, port), profile=image.profile,
+                     max_frames=max_frames)
+        open_boards.append(board)
+        if auto_baud:
+            board.auto_baudrate()
+        rev = board.get_rev()
+        if len(rev) != 2:
+            result = "no response"
+        elif rev[0] > 1:
+            result = "bootloader version %d.%d not supported" % (rev[0], rev[1])
+        else:
+            def progress(p):
+                status[port] = "%d%%" % p
+
+            def log(msg):
+                print("\n%s: %s" % (port, msg), end='', flush=True)
+
+            checkpoint = Checkpoint(port, image, resume)
+            if len(program(board, image, log=log, progress=progress, checkpoint=checkpoint, **options)) > 0:
+                result = "verify failed"
+            else:
+                board.exit_bootloader()
+                result = "ok"
+    except Exception as e:
+        result = str(e)
+    finally:
+        if board is not None:
+            open_boards.remove(board)
+            board.close()
+    status[port] = result
+    return port, result, time.time() - start_time
+
+
+def start_boards(port_names, baudrate=DEFAULT_BAUDRATE):
+    """ Start the application on the cards at all the ports. Returns True
+    if all the ports could be opened. """
+    ok = True
+    for port in port_names:
+        try:
+            board = SB01(port, baudrate=baudrate)
+        except Exception:
+            print("Error opening port \"%s\"" % port)
+            ok = False
+            continue
+        board.exit_bootloader()
+        board.close()
+    return ok
+
+
+def gang_program(port_names, image, **options):
+    """ Program the image on the cards at all the ports in parallel, showing
+    the progress of each. Returns True if all were programmed ok. """
+    status = dict((port, "-") for port in port_names)
+    with ThreadPoolExecutor(max_workers=len(port_names)) as pool:
+        jobs = [pool.submit(program_port, port, image, status, **options) for port in port_names]
+        while not all(job.done() for job in jobs):
+            print("\r" + "  ".join("%s %s" % (port, status[port]) for port in port_names) + "  ", end='', flush=True)
+            time.sleep(0.2)
+        results = [job.result() for job in jobs]
+    print()
+    print("%-16s %-8s %s" % ("Port", "Time", "Result"))
+    for port, result, seconds in results:
+        print("%-16s %-8s %s" % (port, "%.1f s" % seconds, result))
+    return all(r[1] == "ok" for r in results)
+
+
+def station(image, listener, report=None, **options):
+    """ Unattended programming. Every board the hotplug listener reports as
+    attached is programmed and verified, while the image stays loaded. Runs
+    until the listener is closed. report is called after each board.
+    Returns the number of boards programmed ok and the number that failed. """
+    status = {}
+    jobs = {}
+    ok = 0
+    failed = 0
+    closed = False
+
+    def attached(port):
+        start_time = time.time()
+        if wait_for_bootloader(port, options.get("baudrate", DEFAULT_BAUDRATE)) is None:
+            return port, "no bootloader", time.time() - start_time
+        return program_port(port, image, status, **options)
+
+    print("Waiting for boards, press ctrl-C to stop")
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        while True:
+            events = [] if closed else listener.wait(0.2)
+            if events is None:
+                closed = True
+                events = []
+            if closed and len(jobs) == 0:
+                break
+            if closed:
+                time.sleep(0.2)
+            for action, port in events:
+                if action == "add" and port not in jobs:
+                    status[port] = "-"
+                    jobs[port] = pool.submit(attached, port)
+            for port in [p for p in jobs if jobs[p].done()]:
+                port, result, seconds = jobs.pop(port).result()
+                del status[port]
+                if result == "ok":
+                    ok += 1
+                else:
+                    failed += 1
+                print("\r%-16s %-8s %s" % (port, "%.1f s" % seconds, result))
+                print("%d ok, %d failed" % (ok, failed))
+                if report is not None:
+                    report()
+            if len(status) > 0:
+                print("\r" + "  ".join("%s %s" % (port, status[port]) for port in status) + "  ", end='', flush=True)
+    return ok, failed
+
+
+def write_metrics(metrics, name):
+    """ Write the metrics of all boards to name.json and name.prom """
+    values = [metrics[port] for port in sorted(metrics)]
+    write_json(values, name + ".json")
+    write_prometheus(values, name + ".prom")
+
+
+def exit_gracefully(signum=None, frame=None):
+    for b in list(open_boards):
+        b.exit_bootloader()
     sys.exit(0)
 
 
@@ -172,8 +535,9 @@ if __name__ == '__main__':
     # Keep all but the first
     argument_list = full_cmd_arguments[1:]
     try:
-        short_options = "hf:p:s"
-        long_options = ["help", "file=", "port=", "start"]
+        short_options = "hf:p:sw:db:vnaur:m:co:l:e:g:"
+        long_options = ["help", "file=", "port=", "start", "window=", "diff", "base=", "verify", "nocache", "all",
+                        "station", "baud=", "metrics=", "resume", "dump=", "record=", "device=", "frames="]
         arguments, values = getopt.getopt(argument_list, short_options, long_options)
     except getopt.error as err:
         # Output error, and return with an error code
@@ -183,47 +547,172 @@ if __name__ == '__main__':
     # (_, _, filenames) = walk('.').next()
     port = ""
     hex_file = ""
+    window = 4
+    diff = False
+    base_file = ""
+    full_verify = False
+    use_cache = True
+    probe_all = False
+    station_mode = False
+    baudrate = DEFAULT_BAUDRATE
+    auto_baud = False
+    metrics_name = ""
+    resume = False
+    dump_file = ""
+    record_length = 16
+    profile = profiles.SB01
+    max_frames = None
     for current_argument, current_value in arguments:
         if current_argument in ("-f", "--file"):
-            hex_file = current_value
+            hex_file = str.lstrip(current_value, '=:')
         elif current_argument in ("-p", "--port"):
             port = str.lstrip(current_value, '=:')
         elif current_argument in ("-s", "--start"):
             start_application = True
+        elif current_argument in ("-w", "--window"):
+            window = max(1, int(str.lstrip(current_value, '=:')))
+        elif current_argument in ("-d", "--diff"):
+            diff = True
+        elif current_argument in ("-b", "--base"):
+            base_file = str.lstrip(current_value, '=:')
+        elif current_argument in ("-v", "--verify"):
+            full_verify = True
+        elif current_argument in ("-n", "--nocache"):
+            use_cache = False
+        elif current_argument in ("-a", "--all"):
+            probe_all = True
+        elif current_argument in ("-u", "--station"):
+            station_mode = True
+        elif current_argument in ("-r", "--baud"):
+            current_value = str.lstrip(current_value, '=:')
+            if current_value == "auto":
+                auto_baud = True
+            else:
+                baudrate = int(current_value)
+        elif current_argument in ("-m", "--metrics"):
+            metrics_name = str.lstrip(current_value, '=:')
+        elif current_argument in ("-c", "--resume"):
+            resume = True
+        elif current_argument in ("-o", "--dump"):
+            dump_file = str.lstrip(current_value, '=:')
+        elif current_argument in ("-l", "--record"):
+            record_length = int(str.lstrip(current_value, '=:'))
+            if record_length < 1 or record_length > 255:
+                print("The record length must be from 1 to 255 bytes")
+                sys.exit(2)
+        elif current_argument in ("-e", "--device"):
+            profile = profiles.profile_argument(str.lstrip(current_value, '=:'))
+        elif current_argument in ("-g", "--frames"):
+            max_frames = int(str.lstrip(current_value, '=:'))
+            if max_frames < 1 or max_frames > len(DATA_CMDS):
+                print("The frames per command must be from 1 to %d" % len(DATA_CMDS))
+                sys.exit(2)
         else:
             #  current_argument in ("-h", "--help") or any unknown parameter
             print("The following arguments are valid:")
             print("-h  --help           : Will show this help info")
             print("-f  --file=<file>    : Download hex-file to card. Include path and quote if necessary")
-            print("-p  --port=<comport> : Serial port name")
+            print("-p  --port=<comport> : Serial port name, or names separated by comma to program in parallel")
+            print("-a  --all            : Program all ports where a bootloader answers, in parallel")
+            print("-u  --station        : Keep running and program each board when it is attached")
             print("-s  --start          : Start application")
+            print("-r  --baud=<rate>    : Baud rate (default %d), or auto to use the fastest the card answers at"
+                  % DEFAULT_BAUDRATE)
+            print("-w  --window=<n>     : Number of frames or reads sent before waiting for response (default 4)")
+            print("-d  --diff           : Read back the flash and only rewrite pages that differ")
+            print("-b  --base=<file>    : Hex file currently in the card, only rewrite pages that differ")
+            print("-v  --verify         : Read back and compare all flash, not only the CRC")
+            print("-n  --nocache        : Parse the hex file, do not use or update the image cache")
+            print("-m  --metrics=<name> : Write command times and errors to <name>.json and <name>.prom")
+            print("-c  --resume         : Continue an interrupted download, skipping the pages already written")
+            print("-o  --dump=<file>    : Read all flash to a hex file, or to a binary file if it ends with .bin")
+            print("-l  --record=<n>     : Data bytes per record in the dump hex file (default 16)")
+            print("-e  --device=<name>  : Device profile, giving the flash size and page size (default SB01)")
+            print("-g  --frames=<n>     : Most frames (6 bytes) per data command, 1 to %d (default all the bootloader"
+                  " revision is assumed to accept)" % len(DATA_CMDS))
             sys.exit(0)
 
     try:
         start_time = time.time()
 
-        if port == '':
-            port = ports.get_default_port_name()
+        if port == '' and not probe_all and not station_mode:
+            port = ports.find_bootloader(baudrate)
+            if port == '':
+                port = ports.get_default_port_name()
 
-        if port == '' or port is None:
+        if (port == '' or port is None) and not probe_all and not station_mode:
             print("No com-port found")
             sys.exit(1)
+        # Each port once, a port given twice would be programmed twice at once
+        port_names = list(dict.fromkeys(p for p in port.split(',') if p != ''))
+        if len(port_names) == 1:
+            port = port_names[0]
+        if start_application and station_mode:
+            print("The application can not be started in station mode")
+            sys.exit(2)
+        if dump_file != "" and (len(port_names) > 1 or probe_all or station_mode):
+            print("The flash can only be dumped from one port")
+            sys.exit(2)
 
-        if hex_file == "":
+        if hex_file == "" and dump_file == "":
             filenames = glob.glob("./*.hex")
             if len(filenames) != 1:
                 print("No hex files given. Use \"download --file=name.hex\"")
             else:
                 hex_file = filenames[0]
 
+        options = dict(window=window, diff=diff, full_verify=full_verify)
+        try:
+            if not start_application and dump_file == "":
+                image = load_image(hex_file, use_cache, profile)
+            if base_file != "":
+                options["base"] = load_image(base_file, use_cache, profile)
+        except:
+            print("Coud not open file <"+hex_file+">")
+            sys.exit(1)
+        metrics = None
+        if metrics_name != "":
+            metrics = {}
+            atexit.register(write_metrics, metrics, metrics_name)
+        board_options = dict(options, baudrate=baudrate, auto_baud=auto_baud, metrics=metrics, resume=resume,
+                             max_frames=max_frames)
+
+        if station_mode:
+            report = None
+            if metrics is not None:
+                report = lambda: write_metrics(metrics, metrics_name)
+            station(image, hotplug_listener(), report, **board_options)
+            sys.exit(0)
+
+        if probe_all:
+            port_names = ports.probe(baudrate=baudrate)
+            print("Found bootloader on ", port_names)
+        if start_application and (len(port_names) > 1 or probe_all):
+            if not start_boards(port_names, baudrate):
+                sys.exit(1)
+            sys.exit(0)
+        if len(port_names) > 1 or probe_all:
+            if len(port_names) == 0 or not gang_program(port_names, image, **board_options):
+                sys.exit(4)
+            print("Flash programming done. Time used: %.1f sec" % (time.time() - start_time))
+            sys.exit(0)
+
         try:
-            board = SB01(port)
+            board = SB01(port, baudrate=baudrate, metrics=board_metrics(metrics, port), profile=profile,
+                         max_frames=max_frames)
+            open_boards.append(board)
         except:
-            print("Flash programming done. Time used: %d sec" % (time.time() - start_time))
+            print("Flash programming done. Time used: %.1f sec" % (time.time() - start_time))
             print("Error opening port \"%s\"" % port)
             sys.exit(1)
 
         time.sleep(0.2)
+        if auto_baud:
+            rate = board.auto_baudrate()
+            if rate is None:
+                print("No response at any baud rate, using %d" % baudrate)
+            else:
+                print("Using %d baud" % rate)
         rev = board.get_rev()
         if len(rev)==0:
             print("No response freom card. Check cable and connect battery while the <self-test> button is pressed, The led should double-blink.")
@@ -233,53 +722,29 @@ if __name__ == '__main__':
             print("This bootloader version is not supported")
             sys.exit(2)
 
-        try:
-            hex = intelhex.IntelHex(hex_file)
-        except:
-            print("Coud not open file <"+hex_file+">")
-
         if start_application:
             board.exit_bootloader()
             sys.exit(0)
 
-        # Erase all
-        for adr in range(0x0000, 0x5000, 0x800):
-            board.erase(adr)
-
-        # Find last address
-        last_adr = 0x5000
-        for adr in range(0x5000 - 4, 0x0100, -4):
-            b0 = hex[adr * 2 + 0]
-            b1 = hex[adr * 2 + 1]
-            b2 = hex[adr * 2 + 2]
-            b3 = hex[adr * 2 + 4]
-            b4 = hex[adr * 2 + 5]
-            b5 = hex[adr * 2 + 6]
-            if b0 != 0xFF or b1 != 0xFF or b2 != 0xFF or b3 != 0xFF or b4 != 0xFF or b5 != 0xFF:
-                last_adr = adr + 4
-                break
+        if dump_file != "":
+            print("Reading flash 0x0000-0x%04X to %s" % (profile.flash_end - 1, dump_file))
+            dump_flash(board, dump_file, window=window, record_length=record_length, profile=profile)
+            print("Flash dump done. Time used: %.1f sec" % (time.time() - start_time))
+            sys.exit(0)
 
-        print("Last used address in hex file is 0x%X" % last_adr)
         print("Flash programming started at ", datetime.now().strftime("%H:%M:%S"))
 
-        # Write 6 bytes at a time, i.e. 4 words or 2 instructions a 3 bytes.
-        # starting at word 4 (instruction 2) which is interrupt vector
-        board.set_adr(0x0004)
-        for adr in range(0x0004, last_adr, 4):
-            b0 = hex[adr * 2 + 0]
-            b1 = hex[adr * 2 + 1]
-            b2 = hex[adr * 2 + 2]
-            b3 = hex[adr * 2 + 4]
-            b4 = hex[adr * 2 + 5]
-            b5 = hex[adr * 2 + 6]
-            board.write6(b0, b1, b2, b3, b4, b5)
-            p = int(100 * board.current_address / last_adr)
-            print("\r%d%%  " % p, end='', flush=True)
+        def show_progress(p):
+            print("\r%d%%  " % p, end='' if p < 100 else '\n', flush=True)
+
+        if len(program(board, image, progress=show_progress, checkpoint=Checkpoint(port, image, resume),
+                       **options)) > 0:
+            sys.exit(4)
         board.exit_bootloader()
-        print("Flash programming done. Time used: %d sec" % (time.time() - start_time))
+        print("Flash programming done. Time used: %.1f sec" % (time.time() - start_time))
 
     except SystemExit as e:
-        sys.exit(0)
+        sys.exit(e.code)
 
     except:
         traceback.print_exc(file=sys.stdout)
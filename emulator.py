@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        emulator.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Emulator for the SB01 bootloader, used for testing and benchmarking the
+# downloader without hardware. SB01Emulator can be given directly to
+# downloader.SB01 as its serial port, and PtyEmulator serves the same device
+# on a pseudo terminal so the downloader can be run unmodified:
+#
+#     python emulator.py --rates=19200,115200 --latency=4
+#     python downloader.py -f=app.hex -p=/dev/pts/5 --baud=auto
+#
+# The device CRC is the one of the device profile. For SB01 it is assumed
+# to be CRC-16/CCITT over the 3 data bytes of each instruction from
+# app_start (word 0x0004) to the end of flash, sent low byte first.
+
+import collections
+import getopt
+import os
+import random
+import select
+import sys
+import termios
+import threading
+import time
+import tty
+from protocol import ERASE_CMD, ADR_CMD, AUX_CMD, CRC_CMD, START_CMD, REV_CMD, READ_WORD, READ_DWORD, OK_RESP, \
+    ERR_RESP, FRAME_LENGTH, BAUD_LADDER, DATA_CMDS, DEFAULT_BAUDRATE
+from profiles import SB01, profile_argument
+
+BLANK = b'\xFF\xFF\xFF\x00'
+# "goto bootloader" at word 0x0000, kept by the bootloader when page 0 is erased
+RESET_VECTOR = b'\x00\xA3\x04\x00\x00\x00\x00\x00'
+
+
+class SB01Device(object):
+    """ Model of the SB01 bootloader on the device of profile. Flash is
+    stored in hex file layout, 4 bytes per instruction where the 4th
+    (phantom) byte is always zero. Programming can only clear bits, like
+    real flash.
+
+    error_rate is the probability that an erase, address or data command is
+    answered with ERR_RESP without being executed. A rejected data frame still
+    advances the address pointer. drop_rate is the probability that the ack
+    of a successful command is lost. baudrates are the rates the bootloader
+    answers at, None for any rate. A revision before MULTI_FRAME_REVISION
+    only knows DATA_CMD1, and answers the other data commands like any
+    unknown byte. """
+
+    def __init__(self, profile=SB01, revision=(1, 0), error_rate=0.0, drop_rate=0.0, seed=None, baudrates=None):
+        self.profile = profile
+        self.flash_end = profile.flash_end
+        self.page_size = profile.page_size
+        self.revision = revision
+        self.frame_length = dict((cmd, n) for cmd, n in FRAME_LENGTH.items()
+                                 if cmd not in DATA_CMDS[profile.frames_per_command(revision):])
+        self.baudrates = baudrates
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.random = random.Random(seed)
+        self.flash = bytearray(BLANK * (self.flash_end // 2))
+        self.flash[0:len(RESET_VECTOR)] = RESET_VECTOR
+        self.pointer = 0
+        self.started = False
+        self.commands = 0
+        self.errors = 0
+        self.dropped = 0
+        self._rx = bytearray()
+
+    def feed(self, data):
+        """ Receive bytes from the host. Returns a list of (n, cmd, resp)
+        for each completed command, where n is the number of bytes of data
+        received when the command completed. """
+        done = []
+        pending = len(self._rx)
+        self._rx += data
+        consumed = 0
+        while len(self._rx) > 0:
+            cmd = self._rx[0]
+            length = self.frame_length.get(cmd, 1)
+            if len(self._rx) < length:
+                break
+            frame = bytes(self._rx[:length])
+            del self._rx[:length]
+            consumed += length
+            done.append((consumed - pending, cmd, self.execute(frame)))
+        return done
+
+    def abort_frame(self):
+        """ Discard a partly received command, when the line has been quiet """
+        del self._rx[:]
+
+    def answers_at(self, baudrate):
+        return self.baudrates is None or baudrate in self.baudrates
+
+    def execute(self, frame):
+        """ Execute one complete command frame and return the response """
+        self.commands += 1
+        if self.started:
+            return b''
+        cmd = frame[0]
+        if cmd == AUX_CMD:
+            return self._aux(frame[1])
+        if cmd not in self.frame_length:
+            return bytes([ERR_RESP])
+        if self.error_rate > 0 and self.random.random() < self.error_rate:
+            self.errors += 1
+            if cmd != ERASE_CMD and cmd != ADR_CMD:
+                self.pointer += (len(frame) - 1) // 3 * 2
+            return bytes([ERR_RESP])
+        if cmd == ERASE_CMD:
+            ok = self.erase(int.from_bytes(frame[1:5], 'little'))
+        elif cmd == ADR_CMD:
+            self.pointer = int.from_bytes(frame[1:5], 'little')
+            ok = True
+        else:
+            ok = self.program(frame[1:])
+        if not ok:
+            return bytes([ERR_RESP])
+        if self.drop_rate > 0 and self.random.random() < self.drop_rate:
+            self.dropped += 1
+            return b''
+        return bytes([OK_RESP])
+
+    def _aux(self, sub):
+        if sub == CRC_CMD:
+            return self.profile.crc_to_bytes(self.crc())
+        if sub == START_CMD:
+            self.started = True
+            return b''
+        if sub == REV_CMD:
+            return bytes(self.revision)
+        if sub == READ_WORD:
+            self.pointer += 2
+            return self.read(self.pointer - 2, 2)
+        if sub == READ_DWORD:
+            self.pointer += 4
+            return self.read(self.pointer - 4, 4)
+        return bytes([ERR_RESP])
+
+    def erase(self, a):
+        """ Erase the page containing word address a """
+        if a < 0 or a >= self.flash_end:
+            return False
+        page = a - a % self.page_size
+        end = min(page + self.page_size, self.flash_end)
+        self.flash[page * 2:end * 2] = BLANK * ((end - page) // 2)
+        if page == 0:
+            self.flash[0:len(RESET_VECTOR)] = RESET_VECTOR
+        return True
+
+    def program(self, payload):
+        """ Program the instructions in payload (3 bytes each) at the pointer """
+        words = len(payload) // 3 * 2
+        if self.pointer < self.profile.app_start or self.pointer + words > self.flash_end:
+            return False
+        p = self.pointer * 2
+        # Spread the payload out to hex file layout with zero phantom
+        # bytes, and AND all of it into flash as one integer
+        data = bytearray(words * 2)
+        for i in range(3):
+            data[i::4] = payload[i::3]
+        old = int.from_bytes(self.flash[p:p + len(data)], 'little')
+        self.flash[p:p + len(data)] = (old & int.from_bytes(data, 'little')).to_bytes(len(data), 'little')
+        self.pointer += words
+        return True
+
+    def read(self, a, words):
+        """ Flash contents in hex file layout for words starting at a """
+        data = bytearray(self.flash[a * 2:(a + words) * 2])
+        while len(data) < words * 2:
+            data += BLANK
+        return bytes(data)
+
+    def crc(self):
+        """ The CRC returned by CRC_CMD """
+        data = bytearray(self.flash[self.profile.app_start * 2:])
+        del data[3::4]
+        return self.profile.crc(data)
+
+
+class SB01Emulator(object):
+    """ Serial port lookalike connected to an SB01Device. Each byte takes
+    10 bit times on the line in both directions. The response to a command
+    reaches the host latency seconds after the command is executed, like
+    with the latency timer of a USB adapter. Commands are executed one at a
+    time, erase commands take erase_time. With realtime=False the clock is
+    simulated and the emulator never sleeps, the simulated time is then
+    found in clock(). Data written at a baudrate the device does not answer
+    at is lost. loss_rate is the probability that a byte from the host is
+    lost on the line. A command not completed within frame_timeout seconds
+    after its last byte is discarded by the device. """
+
+    def __init__(self, device=None, baudrate=DEFAULT_BAUDRATE, latency=0.0, erase_time=0.0, realtime=True, loss_rate=0.0,
+                 frame_timeout=0.01):
+        if device is None:
+            device = SB01Device()
+        self.device = device
+        self.baudrate = baudrate
+        self.latency = latency
+        self.erase_time = erase_time
+        self.realtime = realtime
+        self.loss_rate = loss_rate
+        self.frame_timeout = frame_timeout
+        self.timeout = None
+        self.is_open = True
+        self.port = "emulator"
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.lost = 0
+        self._now = 0.0
+        self._tx_free = 0.0
+        self._busy = 0.0
+        self._rx_free = 0.0
+        self._rx = collections.deque()
+
+    def clock(self):
+        if self.realtime:
+            return time.perf_counter()
+        return self._now
+
+    def _sleep(self, t):
+        if t <= 0:
+            return
+        if self.realtime:
+            time.sleep(t)
+        else:
+            self._now += t
+
+    def write(self, data):
+        data = bytes(data)
+        byte_time = 10.0 / self.baudrate
+        if self.clock() - self._tx_free > self.frame_timeout:
+            self.device.abort_frame()
+        start = max(self.clock(), self._tx_free)
+        self._tx_free = start + len(data) * byte_time
+        self.bytes_written += len(data)
+        if not self.device.answers_at(self.baudrate):
+            return len(data)
+        if self.loss_rate > 0:
+            kept = bytes(b for b in data if self.device.random.random() >= self.loss_rate)
+            self.lost += len(data) - len(kept)
+            data = kept
+        for n, cmd, resp in self.device.feed(data):
+            t = max(start + n * byte_time, self._busy)
+            if cmd == ERASE_CMD:
+                t += self.erase_time
+            self._busy = t
+            t = max(t + self.latency, self._rx_free)
+            for b in resp:
+                t += byte_time
+                self._rx.append((t, b))
+            self._rx_free = t
+        return len(data)
+
+    def _pop_due(self, size):
+        out = bytearray()
+        now = self.clock()
+        while len(out) < size and len(self._rx) > 0 and self._rx[0][0] <= now:
+            out.append(self._rx.popleft()[1])
+        return out
+
+    def next_due(self):
+        """ Seconds until the next response byte arrives, or None """
+        if len(self._rx) == 0:
+            return None
+        return max(0.0, self._rx[0][0] - self.clock())
+
+    def read(self, size=1):
+        deadline = None
+        if self.timeout is not None:
+            deadline = self.clock() + self.timeout
+        out = bytearray()
+        while True:
+            out += self._pop_due(size - len(out))
+            if len(out) >= size:
+                break
+            if len(self._rx) > 0 and (deadline is None or self._rx[0][0] <= deadline):
+                self._sleep(self._rx[0][0] - self.clock())
+            else:
+                if deadline is not None:
+                    self._sleep(deadline - self.clock())
+                break
+        self.bytes_read += len(out)
+        return bytes(out)
+
+    @property
+    def in_waiting(self):
+        now = self.clock()
+        return sum(1 for t, _ in self._rx if t <= now)
+
+    def flushInput(self):
+        self._pop_due(len(self._rx))
+
+    def reset_input_buffer(self):
+        self.flushInput()
+
+    def flush(self):
+        self._sleep(self._tx_free - self.clock())
+
+    def close(self):
+        self.is_open = False
+
+
+# termios speed constants for the baud rates the host may set
+_SPEEDS = dict((getattr(termios, "B%d" % rate), rate) for rate in BAUD_LADDER if hasattr(termios, "B%d" % rate))
+
+
+class PtyEmulator(threading.Thread):
+    """ Serves an SB01Emulator on a pseudo terminal. The slave device name
+    is found in port and can be opened with serial.Serial. The emulated
+    line runs at the baud rate the host sets on the port, or at baudrate
+    if it is not one of BAUD_LADDER. """
+
+    def __init__(self, device=None, baudrate=DEFAULT_BAUDRATE, latency=0.0, erase_time=0.0, loss_rate=0.0):
+        threading.Thread.__init__(self, daemon=True)
+        self.link = SB01Emulator(device, baudrate, latency, erase_time, loss_rate=loss_rate)
+        self.master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self.running = True
+
+    def run(self):
+        while self.running:
+            wait = self.link.next_due()
+            if wait is None:
+                wait = 0.1
+            r, _, _ = select.select([self.master], [], [], wait)
+            if r:
+                try:
+                    self.link.baudrate = _SPEEDS.get(termios.tcgetattr(self.master)[4], self.link.baudrate)
+                    self.link.write(os.read(self.master, 4096))
+                except OSError:
+                    break
+            out = self.link._pop_due(len(self.link._rx))
+            if len(out) > 0:
+                os.write(self.master, out)
+
+    def stop(self):
+        self.running = False
+        self.join()
+        os.close(self.master)
+        os.close(self._slave)
+
+
+def main():
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], "hr:l:e:d:x:v:t:",
+                                          ["help", "rates=", "latency=", "errors=", "drops=", "loss=", "revision=",
+                                           "device="])
+    except getopt.error as err:
+        print(str(err))
+        sys.exit(2)
+    baudrates = None
+    latency = 0.0
+    error_rate = 0.0
+    drop_rate = 0.0
+    loss_rate = 0.0
+    revision = (1, 0)
+    profile = SB01
+    for current_argument, current_value in arguments:
+        current_value = str.lstrip(current_value, '=:')
+        if current_argument in ("-r", "--rates"):
+            baudrates = [int(rate) for rate in current_value.split(",")]
+        elif current_argument in ("-l", "--latency"):
+            latency = float(current_value) / 1000
+        elif current_argument in ("-e", "--errors"):
+            error_rate = float(current_value)
+        elif current_argument in ("-d", "--drops"):
+            drop_rate = float(current_value)
+        elif current_argument in ("-x", "--loss"):
+            loss_rate = float(current_value)
+        elif current_argument in ("-v", "--revision"):
+            revision = tuple(int(n) for n in current_value.split("."))
+        elif current_argument in ("-t", "--device"):
+            profile = profile_argument(current_value)
+        else:
+            print("The following arguments are valid:")
+            print("-h  --help           : Will show this help info")
+            print("-r  --rates=<list>   : Baud rates answered at, separated by comma (default all)")
+            print("-l  --latency=<ms>   : Turnaround time per command in ms")
+            print("-e  --errors=<p>     : Probability of an error response")
+            print("-d  --drops=<p>      : Probability of a lost ack")
+            print("-x  --loss=<p>       : Probability of a lost byte from the host")
+            print("-v  --revision=<x.y> : Bootloader revision (default 1.0, 1.1 accepts 4 frames per command)")
+            print("-t  --device=<name>  : Device profile, giving the flash size and page size (default SB01)")
+            sys.exit(0)
+    device = SB01Device(profile, revision=revision, error_rate=error_rate, drop_rate=drop_rate, baudrates=baudrates)
+    emulator = PtyEmulator(device, latency=latency, loss_rate=loss_rate)
+    emulator.start()
+    print("SB01 emulator running on %s" % emulator.port)
+    try:
+        while emulator.is_alive():
+            emulator.join(0.5)
+    except KeyboardInterrupt:
+        pass
+    print("%d commands, %d errors, %d lost acks, %d lost bytes" % (device.commands, device.errors, device.dropped,
+                                                                    emulator.link.lost))
+
+
+if __name__ == '__main__':
+    main()
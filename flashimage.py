@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        flashimage.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# The flash contents to program, prepared from a hex file.
+
+from profiles import SB01
+
+BLANK_FRAME = b'\xFF' * 6
+
+
+def strip_phantom(data):
+    """ Remove the phantom byte (the 4th byte of each instruction) from
+    data in hex file layout """
+    data = bytearray(data)
+    del data[3::4]
+    return data
+
+
+def plan_runs(frames, start, min_gap=2):
+    """ Group the frames for word address start and up into runs that are
+    not blank (0xFF) and need to be written. Blank gaps shorter than min_gap
+    frames are written anyway, as a new address costs a round-trip.
+    Returns a list of (address, frames). """
+    runs = []
+    first = None
+    last = None
+    for i in range(len(frames)):
+        if frames[i] == BLANK_FRAME:
+            continue
+        if first is None:
+            first = i
+        elif i - last - 1 >= min_gap:
+            runs.append((start + 4 * first, frames[first:last + 1]))
+            first = i
+        last = i
+    if first is not None:
+        runs.append((start + 4 * first, frames[first:last + 1]))
+    return runs
+
+
+def used_ranges(data):
+    """ The (first, end) byte ranges of data in hex file layout (4 bytes
+    per instruction) where the instructions are not blank """
+    ranges = []
+    view = memoryview(data)
+    first = None
+    for i in range(0, len(data), 4):
+        if view[i:i + 3] == b'\xFF\xFF\xFF':
+            if first is not None:
+                ranges.append((first, i))
+                first = None
+        elif first is None:
+            first = i
+    if first is not None:
+        ranges.append((first, len(data)))
+    return ranges
+
+
+def diff_ranges(expected, got, start):
+    """ Compare instruction data (3 bytes per instruction) for the words
+    from start. Returns the list of (first, end) word address ranges where
+    got differs from expected """
+    ranges = []
+    a = memoryview(expected)
+    b = memoryview(got)
+    if a == b:
+        return ranges
+    block = 3 * 64
+    for i in range(0, len(a), block):
+        if a[i:i + block] == b[i:i + block]:
+            continue
+        for j in range(i, min(i + block, len(a)), 3):
+            if a[j:j + 3] != b[j:j + 3]:
+                adr = start + j // 3 * 2
+                if len(ranges) > 0 and ranges[-1][1] == adr:
+                    ranges[-1] = (ranges[-1][0], adr + 2)
+                else:
+                    ranges.append((adr, adr + 2))
+    return ranges
+
+
+class FlashImage(object):
+    """ The flash contents a hex file programs, 3 bytes per instruction for
+    word address 0 to the flash end of the device profile. Instructions not
+    in the hex file are blank (0xFF). The derived values are calculated when
+    first used, or given when the image comes from the cache. """
+
+    def __init__(self, data, profile=SB01, last_adr=None, crc=None, runs=None, pages=None):
+        self.data = bytes(data)
+        self.profile = profile
+        self.flash_end = profile.flash_end
+        self._last_adr = last_adr
+        self._crc = crc
+        self._runs = runs
+        self._pages = pages
+
+    @classmethod
+    def from_hex(cls, hex, profile=SB01):
+        """ Make an image from an IntelHex object. The pages and the last
+        address are found from the segments of the hex file, only the
+        pages with data need to be looked at. """
+        image = cls(strip_phantom(hex[0:profile.flash_end * 2]), profile)
+        image._pages = [page for page, data in zip(profile.pages, profile.page_data)
+                        if not hex.is_blank(data.start // 3 * 4, data.stop // 3 * 4) and image._used(data)]
+        top = hex.max_addr()
+        image._last_adr = image._last_used(0 if top is None else min(len(image.data), (top // 4 + 1) * 3))
+        return image
+
+    def instructions(self, start, end):
+        """ Data for word address start to end, 3 bytes per instruction """
+        return self.data[start // 2 * 3:end // 2 * 3]
+
+    def frames(self, start, end):
+        """ The 6 byte data frames for word address start to end """
+        data = self.instructions(start, end)
+        return [data[i:i + 6] for i in range(0, len(data), 6)]
+
+    def last_adr(self):
+        """ Word address after the last frame that is not blank """
+        if self._last_adr is None:
+            self._last_adr = self._last_used(len(self.data))
+        return self._last_adr
+
+    def _last_used(self, size):
+        """ last_adr() when the data after the first size bytes is blank """
+        used = len(self.data[:size].rstrip(b'\xFF'))
+        words = (used + 2) // 3 * 2
+        start = self.profile.app_start
+        return max(start, start + (words - start + 3) // 4 * 4)
+
+    def crc(self):
+        """ The CRC the bootloader calculates when the image is programmed,
+        over the instructions from app_start to the end of flash. The
+        algorithm is the one of the profile, which is assumed and not
+        confirmed from the bootloader source, see protocol.crc16(). """
+        if self._crc is None:
+            self._crc = self.profile.crc(self.data[self.profile.app_data])
+        return self._crc
+
+    def runs(self):
+        """ The runs to write when all the image is programmed, as a list of
+        (address, number of frames) """
+        if self._runs is None:
+            start = self.profile.app_start
+            self._runs = [(adr, len(frames)) for adr, frames in plan_runs(self.frames(start, self.last_adr()), start)]
+        return self._runs
+
+    def page_runs(self, pages):
+        """ The runs to write when only the given pages are programmed, as a
+        list of (address, frames) """
+        if set(self.pages()) <= set(pages):
+            return [(adr, self.frames(adr, adr + 4 * n)) for adr, n in self.runs()]
+        runs = []
+        for page in pages:
+            start = max(page, self.profile.app_start)
+            end = min(page + self.profile.page_size, self.last_adr())
+            if start < end:
+                runs += plan_runs(self.frames(start, end), start)
+        return runs
+
+    def page_plan(self, pages):
+        """ The runs of page_runs(pages) split at the page boundaries, as a
+        list of (page, runs) with the runs to write in each page """
+        plan = [(page, []) for page in pages]
+        index = dict((page, i) for i, page in enumerate(pages))
+        page_size = self.profile.page_size
+        for adr, frames in self.page_runs(pages):
+            while len(frames) > 0:
+                page = adr - adr % page_size
+                n = min(len(frames), (page + page_size - adr) // 4)
+                plan[index[page]][1].append((adr, frames[:n]))
+                adr += 4 * n
+                frames = frames[n:]
+        return plan
+
+    def pages(self):
+        """ The pages that hold data, excluding the reset vector """
+        if self._pages is None:
+            self._pages = [page for page, data in zip(self.profile.pages, self.profile.page_data) if self._used(data)]
+        return self._pages
+
+    def _used(self, page_data):
+        return len(self.data[page_data].strip(b'\xFF')) > 0
+
+    def diff_pages(self, other):
+        """ Returns the pages where this image and other differ """
+        return [page for page, data in zip(self.profile.pages, self.profile.page_data)
+                if self.data[data] != other.data[data]]
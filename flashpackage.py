@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        flashpackage.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Precompiled flash image package, made from a hex file once and then
+# downloaded without parsing anything:
+#
+#     python flashpackage.py -f=app.hex -o=app.sbi
+#     python downloader.py -f=app.sbi
+#
+# The file is a header, the table of runs and the payload:
+#
+#     header   magic, format version, device profile name, flash end,
+#              page size and application start, last address, number of
+#              runs and SHA-256 of the run table and payload
+#     runs     word address and number of frames of each run, 2 x uint32
+#     payload  the frames of all runs, 6 bytes each as sent in the data commands
+#
+# All numbers are little endian. The downloader maps the file into memory
+# and takes the frames from the mapping without parsing or packing them.
+# They are still copied once, into the buffer of commands that is sent.
+# The CRC is calculated from the payload when the package is loaded, with
+# the CRC algorithm of the device profile then.
+
+import getopt
+import hashlib
+import mmap
+import struct
+import sys
+import intelhex
+from flashimage import FlashImage, BLANK_FRAME
+from profiles import SB01, profile_argument
+
+MAGIC = b"SB01IMG\x00"
+FORMAT_VERSION = 2
+
+_HEADER = struct.Struct("<8sH16sIIIII32s")
+_RUN = struct.Struct("<II")
+
+
+def is_package(filename):
+    """ True if filename is an image package """
+    try:
+        with open(filename, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_package(image, filename):
+    """ Write the FlashImage image to filename as a package for the device
+    profile of the image """
+    runs = image.runs()
+    table = b"".join(_RUN.pack(adr, n) for adr, n in runs)
+    payload = b"".join(image.instructions(adr, adr + 4 * n) for adr, n in runs)
+    digest = hashlib.sha256(table + payload).digest()
+    profile = image.profile
+    header = _HEADER.pack(MAGIC, FORMAT_VERSION, profile.name.encode(), profile.flash_end, profile.page_size,
+                          profile.app_start, image.last_adr(), len(runs), digest)
+    with open(filename, "wb") as f:
+        f.write(header + table + payload)
+
+
+class PackageImage(FlashImage):
+    """ FlashImage read from a package. The frames are memoryview slices of
+    the file mapped into memory, copied once when the commands are built.
+    The full image data is only made when it is needed, to compare with the
+    flash read back or with another image. """
+
+    def __init__(self, filename, profile=SB01, check=True):
+        with open(filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < _HEADER.size:
+            raise Exception("%s is not an image package" % filename)
+        magic, version, name, self.flash_end, page_size, app_start, self._last_adr, count, digest = \
+            _HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise Exception("%s is not an image package of version %d" % (filename, FORMAT_VERSION))
+        name = name.rstrip(b"\x00").decode()
+        if name != profile.name or self.flash_end != profile.flash_end or page_size != profile.page_size or \
+                app_start != profile.app_start:
+            raise Exception("%s is made for %s with flash end 0x%X" % (filename, name, self.flash_end))
+        self.profile = profile
+        self._crc = None
+        self._runs = [_RUN.unpack_from(self.map, _HEADER.size + _RUN.size * i) for i in range(count)]
+        start = _HEADER.size + _RUN.size * count
+        self.payload = memoryview(self.map)[start:]
+        if len(self.payload) != 6 * sum(n for adr, n in self._runs):
+            raise Exception("%s is truncated" % filename)
+        if check and hashlib.sha256(memoryview(self.map)[_HEADER.size:]).digest() != digest:
+            raise Exception("%s is corrupt" % filename)
+        self._pages = sorted(set(p for adr, n in self._runs
+                                 for p in range(profile.page_of(adr), adr + 4 * n, profile.page_size)))
+        self._data = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            data = bytearray(BLANK_FRAME * (self.flash_end // 4))
+            offset = 0
+            for adr, n in self._runs:
+                data[adr // 2 * 3:adr // 2 * 3 + 6 * n] = self.payload[offset:offset + 6 * n]
+                offset += 6 * n
+            self._data = bytes(data)
+        return self._data
+
+    def page_runs(self, pages):
+        if not set(self._pages) <= set(pages):
+            return FlashImage.page_runs(self, pages)
+        runs = []
+        offset = 0
+        for adr, n in self._runs:
+            runs.append((adr, [self.payload[offset + 6 * i:offset + 6 * i + 6] for i in range(n)]))
+            offset += 6 * n
+        return runs
+
+
+def main():
+    try:
+        arguments, values = getopt.getopt(sys.argv[1:], "hf:o:e:", ["help", "file=", "output=", "device="])
+    except getopt.error as err:
+        print(str(err))
+        sys.exit(2)
+    hex_file = ""
+    output = ""
+    profile = SB01
+    for current_argument, current_value in arguments:
+        current_value = str.lstrip(current_value, '=:')
+        if current_argument in ("-f", "--file"):
+            hex_file = current_value
+        elif current_argument in ("-o", "--output"):
+            output = current_value
+        elif current_argument in ("-e", "--device"):
+            profile = profile_argument(current_value)
+        else:
+            print("The following arguments are valid:")
+            print("-h  --help           : Will show this help info")
+            print("-f  --file=<file>    : Hex file to convert")
+            print("-o  --output=<file>  : Package file to write (default the hex file name with .sbi)")
+            print("-e  --device=<name>  : Device profile of the target (default SB01)")
+            sys.exit(0)
+    if hex_file == "":
+        print("No hex file given. Use \"flashpackage --file=name.hex\"")
+        sys.exit(1)
+    if output == "":
+        output = hex_file.rsplit(".", 1)[0] + ".sbi"
+    image = FlashImage.from_hex(intelhex.IntelHex(hex_file), profile)
+    write_package(image, output)
+    print("Wrote %s, %d frames in %d runs, CRC=0x%04X" % (output, sum(n for adr, n in image.runs()),
+                                                         len(image.runs()), image.crc()))
+
+
+if __name__ == '__main__':
+    main()
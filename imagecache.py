@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        imagecache.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Disk cache of prepared flash images, so a hex file is only parsed the
+# first time it is downloaded. Entries are keyed by a hash of the hex file
+# contents, the device profile (geometry and CRC algorithm) and the cache
+# format version. Each entry is one file with a JSON header line followed by
+# the packed image.
+
+import hashlib
+import io
+import json
+import os
+import intelhex
+from flashimage import FlashImage
+from profiles import SB01, PROFILES
+
+FORMAT_VERSION = 2
+
+
+def default_directory():
+    return os.path.join(os.path.expanduser("~"), ".sb01-downloader", "cache")
+
+
+class ImageCache(object):
+    """ Cache of FlashImage objects. The least recently used entries are
+    removed when there are more than max_entries or they take more than
+    max_bytes. Errors writing the cache are ignored, the image is then
+    just parsed every time. """
+
+    def __init__(self, directory=None, max_entries=32, max_bytes=16 * 1024 * 1024):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content, profile=SB01):
+        h = hashlib.sha256()
+        h.update(b"%d:%s:" % (FORMAT_VERSION, profile.signature().encode()))
+        h.update(content)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    def load(self, filename, profile=SB01):
+        """ Returns the FlashImage for the hex file filename, from the cache
+        if it is there, else by parsing the file and storing the result """
+        with open(filename, "rb") as f:
+            content = f.read()
+        key = self.key(content, profile)
+        image = self.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = FlashImage.from_hex(intelhex.IntelHex(io.BytesIO(content)), profile)
+        self.put(key, image, filename)
+        return image
+
+    def get(self, key):
+        """ Returns the cached FlashImage for key, or None """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                header = json.loads(f.readline())
+                data = f.read()
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        if header.get("version") != FORMAT_VERSION or len(data) != header["size"] or \
+                header.get("profile") not in PROFILES:
+            return None
+        return FlashImage(data, PROFILES[header["profile"]], header["last_adr"], header["crc"],
+                          [tuple(r) for r in header["runs"]], header["pages"])
+
+    def put(self, key, image, source=""):
+        """ Store image as key, and remove old entries """
+        header = {
+            "version": FORMAT_VERSION,
+            "source": os.path.basename(source),
+            "profile": image.profile.name,
+            "size": len(image.data),
+            "last_adr": image.last_adr(),
+            "crc": image.crc(),
+            "runs": image.runs(),
+            "pages": image.pages(),
+        }
+        path = self._path(key)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + ".tmp", "wb") as f:
+                f.write(json.dumps(header).encode() + b"\n")
+                f.write(image.data)
+            os.replace(path + ".tmp", path)
+            self.evict()
+        except OSError:
+            pass
+
+    def evict(self):
+        """ Remove the least recently used entries until the cache is
+        within max_entries and max_bytes """
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".img"):
+                st = os.stat(os.path.join(self.directory, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        while len(entries) > 0 and (len(entries) > self.max_entries or total > self.max_bytes):
+            _, size, name = entries.pop(0)
+            os.remove(os.path.join(self.directory, name))
+            total -= size
+
@@ -37,20 +37,42 @@
 @version    1.4
 Modified by Jan Kåre Vatne
 """
+import io
 from array import array
 from binascii import unhexlify
+from bisect import bisect_right
+
+# Records closer than this to an existing segment are merged into it,
+# the bytes in between are filled with padding.
+_MAX_GAP = 64
+
+
+class _Segment(object):
+    """ Contiguous range of the image. cover has one byte per data byte,
+    set to 1 where the data came from the file and 0 for padding. """
+    __slots__ = ('start', 'data', 'cover')
+
+    def __init__(self, start, data, cover):
+        self.start = start
+        self.data = data
+        self.cover = cover
+
+    @property
+    def end(self):
+        return self.start + len(self.data)
 
 
 class IntelHex(object):
     """ Intel HEX file reader. """
 
-    def __init__(self, source=None):
+    def __init__(self, source=None, bulk=True):
         """ Constructor. If source specified, object will be initialized
         with the contents of source. Otherwise the object will be empty.
 
         @param  source      source for initialization
                             (file name of HEX file, file object, addr dict or
                              other IntelHex object)
+        @param  bulk        use loadhex_bulk() instead of loadhex()
         """
         # public members
         self.padding = 0x0FF
@@ -58,12 +80,80 @@ class IntelHex(object):
         self.start_addr = None
 
         # private members
-        self._buf = {}
+        self._segments = []
+        self._starts = []
+        self._ranges = None
+        self._range_starts = []
+        self._size = 0
         self._offset = 0
-        self.loadhex(source)
+        if source is None:
+            pass
+        elif bulk:
+            self.loadhex_bulk(source)
+        else:
+            self.loadhex(source)
 
     def size(self):
-        return len(self._buf)
+        return self._size
+
+    def _put(self, addr, data, line=0):
+        """ Store data at addr.
+
+        @raise  AddressOverlapError  if any of the addresses already has data.
+        """
+        self._ranges = None
+        end = addr + len(data)
+        segments = self._segments
+        if segments and segments[-1].end == addr:
+            # Records are usually in increasing address order
+            seg = segments[-1]
+            seg.data += data
+            seg.cover += b'\x01' * len(data)
+            self._size += len(data)
+            return
+        i = bisect_right(self._starts, addr) - 1
+        # Overlap check against the segment before addr and those starting inside the record
+        j = max(i, 0)
+        while j < len(segments) and segments[j].start < end:
+            seg = segments[j]
+            lo = max(addr, seg.start) - seg.start
+            hi = min(end, seg.end) - seg.start
+            if lo < hi:
+                k = seg.cover.find(1, lo, hi)
+                if k >= 0:
+                    raise AddressOverlapError(address=seg.start + k, line=line)
+            j += 1
+
+        # Segments within _MAX_GAP of the record are merged with it
+        first = i if i >= 0 and segments[i].end + _MAX_GAP >= addr else i + 1
+        last = first
+        while last < len(segments) and segments[last].start <= end + _MAX_GAP:
+            last += 1
+        if first == last:
+            seg = _Segment(addr, bytearray(data), bytearray(b'\x01') * len(data))
+            segments.insert(first, seg)
+            self._starts.insert(first, addr)
+        else:
+            seg = segments[first]
+            if addr < seg.start:
+                gap = seg.start - addr
+                seg.data[0:0] = bytearray([self.padding]) * gap
+                seg.cover[0:0] = bytearray(gap)
+                seg.start = addr
+                self._starts[first] = addr
+            for other in segments[first + 1:last]:
+                gap = other.start - seg.end
+                seg.data += bytearray([self.padding]) * gap + other.data
+                seg.cover += bytearray(gap) + other.cover
+            del segments[first + 1:last]
+            del self._starts[first + 1:last]
+            if end > seg.end:
+                gap = end - seg.end
+                seg.data += bytearray([self.padding]) * gap
+                seg.cover += bytearray(gap)
+            seg.data[addr - seg.start:end - seg.start] = data
+            seg.cover[addr - seg.start:end - seg.start] = b'\x01' * len(data)
+        self._size += len(data)
 
     def _decode_record(self, s, line=0):
         """Decode one record of HEX file.
@@ -83,11 +173,21 @@ class IntelHex(object):
             except (TypeError, ValueError):
                 # this might be raised by unhexlify when odd hexascii digits
                 raise HexRecordError(line=line)
-            length = len(bin)
-            if length < 5:
-                raise HexRecordError(line=line)
         else:
             raise HexRecordError(line=line)
+        self._apply_record(bin, line)
+
+    def _apply_record(self, bin, line=0):
+        """Check and apply one decoded record.
+
+        @param  bin     record bytes, from length to checksum.
+        @param  line    line number (for error messages).
+
+        @raise  EndOfFile   if EOF record encountered.
+        """
+        length = len(bin)
+        if length < 5:
+            raise HexRecordError(line=line)
 
         record_length = bin[0]
         if length != (5 + record_length):
@@ -107,13 +207,10 @@ class IntelHex(object):
         if record_type == 0:
             # data record
             addr += self._offset
-            for i in range(4, 4 + record_length):
-                if not self._buf.get(addr, None) is None:
-                    raise AddressOverlapError(address=addr, line=line)
-                self._buf[addr] = bin[i]
-                addr += 1  # FIXME: addr should be wrapped
-                # BUT after 02 record (at 64K boundary)
-                # and after 04 record (at 4G boundary)
+            # FIXME: addr should be wrapped
+            # BUT after 02 record (at 64K boundary)
+            # and after 04 record (at 4G boundary)
+            self._put(addr, bin[4:4 + record_length], line)
 
         elif record_type == 1:
             # end of file record
@@ -183,15 +280,214 @@ class IntelHex(object):
             if fclose:
                 fclose()
 
+    def loadhex_bulk(self, fobj):
+        """Load hex file like loadhex(), but read the whole file and decode
+        all records with one unhexlify() call. Falls back to loadhex() if
+        the file has lines that are not valid hex records, so errors are
+        reported the same way.
+
+        @param  fobj        file name or file-like object
+        """
+        if getattr(fobj, "read", None) is None:
+            with open(fobj, "rb") as f:
+                data = f.read()
+        else:
+            data = fobj.read()
+        if isinstance(data, str):
+            data = data.encode('latin-1')
+
+        lines = data.split(b'\n')
+        numbers = []
+        bodies = []
+        for i, s in enumerate(lines):
+            s = s.rstrip(b'\r')
+            if not s:
+                continue
+            if s[0] != 0x3A or len(s) & 1 == 0:
+                bodies = None
+                break
+            numbers.append(i + 1)
+            bodies.append(s[1:])
+        blob = None
+        if bodies is not None:
+            try:
+                blob = memoryview(unhexlify(b''.join(bodies)))
+            except (TypeError, ValueError):
+                pass
+        if blob is None:
+            self.loadhex(io.StringIO(data.decode('latin-1')))
+            return
+
+        # Data records that follow each other are collected in runs and
+        # stored with one _put(), other records go through _apply_record().
+        self._offset = 0
+        apply = self._apply_record
+        run = []
+        run_end = None
+        pos = 0
+        try:
+            for line, s in zip(numbers, bodies):
+                n = len(s) >> 1
+                rec = blob[pos:pos + n]
+                pos += n
+                if n >= 5 and rec[3] == 0 and rec[0] + 5 == n and sum(rec) & 0xFF == 0:
+                    addr = self._offset + rec[1] * 256 + rec[2]
+                    if addr != run_end:
+                        self._put_run(run)
+                        run = []
+                    run.append((line, addr, rec[4:n - 1]))
+                    run_end = addr + n - 5
+                    continue
+                self._put_run(run)
+                run = []
+                run_end = None
+                apply(rec, line)
+        except _EndOfFile:
+            pass
+        self._put_run(run)
+
+    def _put_run(self, run):
+        """ Store a list of (line, addr, data) records with consecutive addresses """
+        if len(run) == 0:
+            return
+        try:
+            self._put(run[0][1], b''.join(data for _, _, data in run), run[0][0])
+            return
+        except AddressOverlapError:
+            pass
+        # Store record by record to report the line that overlaps
+        for line, addr, data in run:
+            self._put(addr, data, line)
+
+    def _data_ranges(self):
+        """ The (start, end) address ranges with data from the file, found
+        from the cover of the segments when first needed """
+        if self._ranges is None:
+            ranges = []
+            for seg in self._segments:
+                i = seg.cover.find(1)
+                while i >= 0:
+                    j = seg.cover.find(0, i)
+                    if j < 0:
+                        j = len(seg.cover)
+                    ranges.append((seg.start + i, seg.start + j))
+                    i = seg.cover.find(1, j)
+            self._ranges = ranges
+            self._range_starts = [start for start, end in ranges]
+        return self._ranges
+
+    def segments(self):
+        """ The address ranges that hold data, as a sorted list of
+        (start, end) with end not included """
+        return list(self._data_ranges())
+
+    def min_addr(self):
+        """ The lowest address with data, or None if there is no data """
+        ranges = self._data_ranges()
+        if len(ranges) == 0:
+            return None
+        return ranges[0][0]
+
+    def max_addr(self):
+        """ The highest address with data, or None if there is no data """
+        ranges = self._data_ranges()
+        if len(ranges) == 0:
+            return None
+        return ranges[-1][1] - 1
+
+    def is_blank(self, start, end):
+        """ True if no address from start to end (not included) has data.
+        Takes O(log n) for n segments. """
+        if start >= end:
+            return True
+        ranges = self._data_ranges()
+        i = bisect_right(self._range_starts, start) - 1
+        if i >= 0 and ranges[i][1] > start:
+            return False
+        return i + 1 == len(ranges) or ranges[i + 1][0] >= end
+
     def __getitem__(self, addr):
-        """ Get requested byte from address.
-        @param  addr    address of byte.
+        """ Get requested byte from address, or a range of bytes.
+        @param  addr    address of byte, or slice start:stop.
         @return         byte if address exists in HEX file, or self.padding
-                        if no data found.
+                        if no data found. A slice returns bytes, padded where
+                        the HEX file has no data.
         """
+        if isinstance(addr, slice):
+            return self._getslice(addr)
         if addr < 0:
             raise TypeError('Address should be >= 0.')
-        return self._buf.get(addr, self.padding)
+        i = bisect_right(self._starts, addr) - 1
+        if i >= 0:
+            seg = self._segments[i]
+            if addr < seg.end:
+                return seg.data[addr - seg.start]
+        return self.padding
+
+    def _getslice(self, s):
+        if s.step is not None and s.step != 1:
+            raise TypeError('Slice step is not supported.')
+        start = s.start or 0
+        stop = s.stop
+        if stop is None:
+            stop = self._segments[-1].end if self._segments else start
+        if start < 0 or stop < 0:
+            raise TypeError('Address should be >= 0.')
+        out = bytearray([self.padding]) * max(stop - start, 0)
+        i = max(bisect_right(self._starts, start) - 1, 0)
+        while i < len(self._segments) and self._segments[i].start < stop:
+            seg = self._segments[i]
+            lo = max(start, seg.start)
+            hi = min(stop, seg.end)
+            if lo < hi:
+                out[lo - start:hi - start] = seg.data[lo - seg.start:hi - seg.start]
+            i += 1
+        return bytes(out)
+
+
+class IntelHexWriter(object):
+    """ Intel HEX file writer. The data is written as it is given, nothing
+    is kept in memory. Records hold up to record_length bytes and do not
+    cross a 64K boundary. An extended linear address record is written when
+    the upper 16 bits of the address change. """
+
+    def __init__(self, fobj, record_length=16):
+        """
+        @param  fobj            file name or text file-like object
+        @param  record_length   data bytes per record, 1 to 255
+        """
+        if not 1 <= record_length <= 255:
+            raise ValueError("Record length should be 1 to 255")
+        if getattr(fobj, "write", None) is None:
+            fobj = open(fobj, "w")
+            self._fclose = fobj.close
+        else:
+            self._fclose = None
+        self.fobj = fobj
+        self.record_length = record_length
+        self._upper = 0
+
+    def _record(self, addr, record_type, data):
+        rec = bytes([len(data), (addr >> 8) & 0xFF, addr & 0xFF, record_type]) + bytes(data)
+        self.fobj.write(":" + (rec + bytes([-sum(rec) & 0xFF])).hex().upper() + "\n")
+
+    def write(self, addr, data):
+        """ Write data for the addresses from addr """
+        pos = 0
+        while pos < len(data):
+            a = addr + pos
+            if a >> 16 != self._upper:
+                self._upper = a >> 16
+                self._record(0, 4, self._upper.to_bytes(2, 'big'))
+            n = min(self.record_length, len(data) - pos, 0x10000 - (a & 0xFFFF))
+            self._record(a & 0xFFFF, 0, data[pos:pos + n])
+            pos += n
+
+    def close(self):
+        """ Write the end of file record """
+        self._record(0, 1, b'')
+        if self._fclose:
+            self._fclose()
 
 
 class IntelHexError(Exception):
@@ -290,6 +586,7 @@ def main():
     try:
         h = IntelHex('test.hex')
         print("Length=%d"%(h.size()))
+        print("Segments " + " ".join("0x%X-0x%X" % (start, end - 1) for start, end in h.segments()))
         print(hex(h[0]))
         print(hex(h[1]))
         print(hex(h[2]))
@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        metrics.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Instrumentation of the bootloader commands. A Metrics object given to
+# AsyncSB01 (or downloader.SB01) records the response time of each command,
+# the bytes sent and received, timeouts, error responses and resends. The
+# results of all boards can be written as JSON, or as a Prometheus text file
+# for the node exporter textfile collector.
+
+import json
+import os
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+COMMANDS = ("erase", "adr", "data", "read", "rev", "crc")
+
+
+class CommandMetrics(object):
+    """ Counters for one command """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.timeouts = 0
+        self.errors = 0
+        self.retries = 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "seconds": self.seconds,
+            "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.buckets)),
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "retries": self.retries,
+        }
+
+
+class Metrics(object):
+    """ Measurements for one board. clock is the time source, give the
+    clock() of an emulator running on simulated time. """
+
+    def __init__(self, board="", clock=time.perf_counter):
+        self.board = board
+        self.clock = clock
+        self.commands = dict((name, CommandMetrics()) for name in COMMANDS)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.first = None
+        self.last = None
+
+    def record(self, command, latency, sent, received, timeout=False, error=False):
+        """ Record a command answered after latency seconds. sent and
+        received are the number of bytes. """
+        now = self.clock()
+        start = now - latency
+        c = self.commands[command]
+        c.count += 1
+        c.seconds += latency
+        i = 0
+        while i < len(BUCKETS) and latency > BUCKETS[i]:
+            i += 1
+        c.buckets[i] += 1
+        if timeout:
+            c.timeouts += 1
+        if error:
+            c.errors += 1
+        self.bytes_sent += sent
+        self.bytes_received += received
+        if self.first is None or start < self.first:
+            self.first = start
+        self.last = now
+
+    def retry(self, command):
+        """ Count a resend of command """
+        self.commands[command].retries += 1
+
+    def elapsed(self):
+        """ Seconds from the first command was sent to the last response """
+        if self.first is None:
+            return 0.0
+        return self.last - self.first
+
+    def bytes_per_second(self):
+        if self.elapsed() <= 0:
+            return 0.0
+        return (self.bytes_sent + self.bytes_received) / self.elapsed()
+
+    def to_dict(self):
+        return {
+            "board": self.board,
+            "seconds": self.elapsed(),
+            "bytes_sent": self.bytes_sent,
+            "bytes_received": self.bytes_received,
+            "bytes_per_second": self.bytes_per_second(),
+            "commands": dict((name, c.to_dict()) for name, c in self.commands.items() if c.count > 0),
+        }
+
+    def prometheus(self):
+        """ The metrics in the Prometheus text format, without the HELP and
+        TYPE lines """
+        lines = []
+        board = 'board="%s"' % self.board.replace('\\', '\\\\').replace('"', '\\"')
+        for name, c in self.commands.items():
+            if c.count == 0:
+                continue
+            labels = '%s,command="%s"' % (board, name)
+            total = 0
+            for bound, n in zip([str(b) for b in BUCKETS] + ["+Inf"], c.buckets):
+                total += n
+                lines.append('sb01_command_seconds_bucket{%s,le="%s"} %d' % (labels, bound, total))
+            lines.append('sb01_command_seconds_sum{%s} %f' % (labels, c.seconds))
+            lines.append('sb01_command_seconds_count{%s} %d' % (labels, c.count))
+            lines.append('sb01_command_timeouts_total{%s} %d' % (labels, c.timeouts))
+            lines.append('sb01_command_errors_total{%s} %d' % (labels, c.errors))
+            lines.append('sb01_command_retries_total{%s} %d' % (labels, c.retries))
+        lines.append('sb01_bytes_sent_total{%s} %d' % (board, self.bytes_sent))
+        lines.append('sb01_bytes_received_total{%s} %d' % (board, self.bytes_received))
+        lines.append('sb01_bytes_per_second{%s} %f' % (board, self.bytes_per_second()))
+        return lines
+
+
+_TYPES = [
+    ("sb01_command_seconds", "histogram", "Time from a command is sent until its response is received"),
+    ("sb01_command_timeouts_total", "counter", "Commands without a complete response"),
+    ("sb01_command_errors_total", "counter", "Commands answered with an error response"),
+    ("sb01_command_retries_total", "counter", "Commands sent again after an error or timeout"),
+    ("sb01_bytes_sent_total", "counter", "Bytes sent to the board"),
+    ("sb01_bytes_received_total", "counter", "Bytes received from the board"),
+    ("sb01_bytes_per_second", "gauge", "Bytes sent and received per second while programming"),
+]
+
+
+def _write(filename, text):
+    with open(filename + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(filename + ".tmp", filename)
+
+
+def write_json(metrics, filename):
+    """ Write a list of Metrics to filename as JSON """
+    _write(filename, json.dumps([m.to_dict() for m in metrics], indent=2) + "\n")
+
+
+def write_prometheus(metrics, filename):
+    """ Write a list of Metrics to filename in the Prometheus text format """
+    lines = []
+    for m in metrics:
+        lines += m.prometheus()
+    text = []
+    for name, kind, help in _TYPES:
+        text.append("# HELP %s %s" % (name, help))
+        text.append("# TYPE %s %s" % (name, kind))
+        text += [line for line in lines if line.startswith(name + "{") or line.startswith(name + "_")]
+    _write(filename, "\n".join(text) + "\n")
@@ -4,11 +4,80 @@
 # Author:      Jan Kåre Vatne
 # -------------------------------------------------------------------------------
 
+import glob
+import json
+import os
+import queue
+import re
+import select
+import socket
+import sys
+import time
 import serial
+import serial.tools.list_ports
+from concurrent.futures import ThreadPoolExecutor
 from typing import Callable
-import win32api
-import win32con
-import win32gui
+from protocol import AUX_CMD, REV_CMD, DEFAULT_BAUDRATE
+
+try:
+    import win32api
+    import win32con
+    import win32gui
+except ImportError:
+    win32gui = None
+
+
+def list_port_names():
+    """ Returns the names of the serial ports on this computer, with the
+    USB serial adapters found by name on Linux """
+    names = [p.device for p in serial.tools.list_ports.comports()]
+    if sys.platform.startswith("linux"):
+        names += glob.glob("/dev/ttyUSB*") + glob.glob("/dev/ttyACM*")
+    return sorted(set(names), key=lambda n: (port_number(n), n))
+
+
+def port_number(name):
+    """ The number at the end of a port name, COM5 gives 5 """
+    m = re.search(r"(\d+)$", name)
+    if m is None:
+        return -1
+    return int(m.group(1))
+
+
+def probe_port(name, baudrate=DEFAULT_BAUDRATE, timeout=0.2):
+    """ Ask for the bootloader revision on port name. Returns the 2 byte
+    revision, or None if the port can not be opened or does not answer. """
+    try:
+        s = serial.Serial(name, baudrate=baudrate, timeout=timeout)
+    except (serial.SerialException, OSError, ValueError):
+        return None
+    try:
+        s.reset_input_buffer()
+        s.write(bytes([AUX_CMD, REV_CMD]))
+        resp = s.read(2)
+    except (serial.SerialException, OSError):
+        return None
+    finally:
+        s.close()
+    if len(resp) != 2:
+        return None
+    return resp
+
+
+def wait_for_bootloader(name, baudrate=DEFAULT_BAUDRATE, timeout=5.0):
+    """ Probe port name until a bootloader answers. A port that was just
+    attached may not be ready to open, and the board may still be starting.
+    Returns the revision, or None after timeout seconds. """
+    end = time.time() + timeout
+    while True:
+        rev = probe_port(name, baudrate)
+        if rev is not None or time.time() > end:
+            return rev
+        time.sleep(0.1)
+
+
+def default_cache_file():
+    return os.path.join(os.path.expanduser("~"), ".sb01-downloader", "ports.json")
 
 
 class ComPorts(object):
@@ -16,25 +85,29 @@ class ComPorts(object):
     Encapsules the COM ports. The application should create one object
     containing a list of COM-ports.  Calling scanConnections() will update
     the list and getAvailable() returns the list.
+
+    probe() finds the ports where an SB01 bootloader answers. The answers
+    are kept for max_age seconds, and the last port found is saved in
+    cache_file and tried first by find_bootloader().
     """
 
-    def __init__(self):
+    def __init__(self, cache_file=None, max_age=10.0):
+        if cache_file is None:
+            cache_file = default_cache_file()
+        self.cache_file = cache_file
+        self.max_age = max_age
         self.available = []
         self.namelist = []
+        self._probed = {}
         self.scan_connections()
 
     def scan_connections(self):
         self.available = []
         self.namelist = []
         self.namelist.append("Select port...")
-        for i in range(0, 255):
-            try:
-                s = serial.Serial("COM%d" % i)
-                self.available.append((i, s.portstr))
-                self.namelist.append(s.portstr)
-                s.close()
-            except serial.SerialException:
-                pass
+        for name in list_port_names():
+            self.available.append((port_number(name), name))
+            self.namelist.append(name)
         return self.available
 
     def get_available(self):
@@ -66,10 +139,61 @@ class ComPorts(object):
                 return n[0]
             i = i + 1
 
+    def probe(self, names=None, baudrate=DEFAULT_BAUDRATE, timeout=0.2):
+        """ Returns the ports among names (default all ports found) where a
+        bootloader answers, probing the ports in parallel. Answers newer than
+        max_age seconds are reused. """
+        if names is None:
+            names = [n[1] for n in self.available]
+        now = time.time()
+        todo = [n for n in names if n not in self._probed or now - self._probed[n][0] > self.max_age]
+        if len(todo) > 0:
+            with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+                for name, rev in zip(todo, pool.map(lambda n: probe_port(n, baudrate, timeout), todo)):
+                    self._probed[name] = (now, rev)
+        return [n for n in names if self._probed[n][1] is not None]
+
+    def revision(self, name):
+        """ The revision of the bootloader last found at port name, or None """
+        if name not in self._probed:
+            return None
+        return self._probed[name][1]
+
+    def find_bootloader(self, baudrate=DEFAULT_BAUDRATE, timeout=0.2):
+        """ Returns the name of a port where a bootloader answers, or "".
+        The port found last time is tried first. If several answer, the
+        highest numbered is used. """
+        names = [n[1] for n in self.available]
+        last = self._load_last()
+        if last in names and len(self.probe([last], baudrate, timeout)) > 0:
+            return last
+        found = self.probe(names, baudrate, timeout)
+        if len(found) == 0:
+            return ""
+        self._save_last(found[-1])
+        return found[-1]
+
+    def _load_last(self):
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f).get("port")
+        except (OSError, ValueError):
+            return None
+
+    def _save_last(self, name):
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(self.cache_file, "w") as f:
+                json.dump({"port": name}, f)
+        except OSError:
+            pass
+
 
 class DeviceListener:
 
     def __init__(self, on_change: Callable):
+        if win32gui is None:
+            raise Exception("DeviceListener needs pywin32")
         self.on_change = on_change
         self._create_window()
 
@@ -86,3 +210,96 @@ class DeviceListener:
             self.on_change()
         return 0
 
+
+class PollingListener(object):
+    """ Finds attached and removed ports by listing the ports every interval
+    seconds. wait() returns a list of ("add" or "remove", port name). """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.known = set(list_port_names())
+
+    def wait(self, timeout=None):
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            names = set(list_port_names())
+            events = [("add", n) for n in sorted(names - self.known)] + \
+                     [("remove", n) for n in sorted(self.known - names)]
+            self.known = names
+            if len(events) > 0 or (end is not None and time.time() >= end):
+                return events
+            time.sleep(self.interval if end is None else max(0.0, min(self.interval, end - time.time())))
+
+    def close(self):
+        pass
+
+
+class NetlinkListener(object):
+    """ Linux kernel uevents for tty devices, read from a netlink socket.
+    wait() returns a list of ("add" or "remove", port name). The device file
+    is created by udev shortly after the event. """
+
+    NETLINK_KOBJECT_UEVENT = 15
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, self.NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, 1))
+
+    def wait(self, timeout=None):
+        events = []
+        r, _, _ = select.select([self.sock], [], [], timeout)
+        while r:
+            event = self.parse(self.sock.recv(8192))
+            if event is not None:
+                events.append(event)
+            r, _, _ = select.select([self.sock], [], [], 0)
+        return events
+
+    @staticmethod
+    def parse(msg):
+        """ Returns (action, port name) for a tty add or remove uevent, else None """
+        fields = dict(f.split("=", 1) for f in msg.decode("latin-1").split("\0") if "=" in f)
+        if fields.get("SUBSYSTEM") != "tty" or "DEVNAME" not in fields:
+            return None
+        if fields.get("ACTION") not in ("add", "remove"):
+            return None
+        return fields["ACTION"], "/dev/" + fields["DEVNAME"]
+
+    def close(self):
+        self.sock.close()
+
+
+class SimulatedListener(object):
+    """ Hotplug events made by calling attach() and detach(), for testing.
+    After close() wait() returns None. """
+
+    def __init__(self):
+        self.events = queue.Queue()
+
+    def attach(self, name):
+        self.events.put(("add", name))
+
+    def detach(self, name):
+        self.events.put(("remove", name))
+
+    def wait(self, timeout=None):
+        try:
+            event = self.events.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        if event is None:
+            return None
+        return [event]
+
+    def close(self):
+        self.events.put(None)
+
+
+def hotplug_listener():
+    """ The best listener for ports attached and removed on this computer """
+    if sys.platform.startswith("linux"):
+        try:
+            return NetlinkListener()
+        except OSError:
+            pass
+    return PollingListener()
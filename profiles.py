@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        profiles.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Device profiles. A profile declares the flash geometry of a device and
+# what its bootloader supports, and holds the page tables derived from the
+# geometry, so the rest of the downloader works for any size of flash. A
+# new device is added by adding its profile to PROFILES.
+
+import sys
+from protocol import FLASH_END, PAGE_SIZE, APP_START, BAUD_LADDER, DATA_CMDS, frames_per_command, crc16
+
+
+class DeviceProfile(object):
+    """ Geometry and bootloader capabilities of a device. Word addresses
+    are used for flash_end, page_size and app_start, the first word the
+    application may write. baudrates are the rates the bootloader can run
+    at, fastest first, and max_frames the most 6 byte frames it accepts in
+    one data command. The bootloader CRC of the application is
+    crc_function(data, crc_init) over the 3 data bytes of each instruction
+    from app_start to flash_end, sent with crc_byteorder. The default is an
+    assumption, see protocol.crc16(). """
+
+    def __init__(self, name, flash_end, page_size=PAGE_SIZE, app_start=APP_START, baudrates=BAUD_LADDER,
+                 max_frames=len(DATA_CMDS), crc_function=crc16, crc_init=0xFFFF, crc_byteorder='little'):
+        self.name = name
+        self.flash_end = flash_end
+        self.page_size = page_size
+        self.app_start = app_start
+        self.baudrates = tuple(baudrates)
+        self.max_frames = max_frames
+        self.crc_function = crc_function
+        self.crc_init = crc_init
+        self.crc_byteorder = crc_byteorder
+        # The page tables. pages are the word addresses of the pages, and
+        # page_data the slice of each page in the instruction data (3 bytes
+        # per instruction) without the words below app_start.
+        self.pages = tuple(range(0, flash_end, page_size))
+        self.page_data = tuple(slice(max(page, app_start) // 2 * 3, (page + page_size) // 2 * 3)
+                               for page in self.pages)
+        self.app_data = slice(app_start // 2 * 3, flash_end // 2 * 3)
+
+    def page_of(self, adr):
+        """ Word address of the page holding word address adr """
+        return adr - adr % self.page_size
+
+    def signature(self):
+        """ The fields an image made from a hex file depends on, for keys of
+        cached images """
+        return "%s:%X:%X:%X:%s:%X:%s" % (self.name, self.flash_end, self.page_size, self.app_start,
+                                         getattr(self.crc_function, "__qualname__", repr(self.crc_function)),
+                                         self.crc_init, self.crc_byteorder)
+
+    def crc(self, data):
+        """ The bootloader CRC of data, 3 bytes per instruction """
+        return self.crc_function(data, self.crc_init)
+
+    def crc_from_bytes(self, resp):
+        """ The CRC in the 2 byte response to CRC_CMD """
+        return int.from_bytes(resp, self.crc_byteorder)
+
+    def crc_to_bytes(self, crc):
+        return crc.to_bytes(2, self.crc_byteorder)
+
+    def frames_per_command(self, revision):
+        """ The most frames in one data command for a bootloader revision """
+        return min(self.max_frames, frames_per_command(revision))
+
+
+SB01 = DeviceProfile("SB01", FLASH_END)
+
+PROFILES = {
+    SB01.name: SB01,
+}
+
+
+def get_profile(name):
+    """ The profile of the device name """
+    if name not in PROFILES:
+        raise Exception("Unknown device %s, known devices are %s" % (name, ", ".join(sorted(PROFILES))))
+    return PROFILES[name]
+
+
+def profile_argument(name):
+    """ The profile of the device name given on the command line. If there
+    is no such device the known devices are printed and the program exits
+    with code 2. """
+    if name not in PROFILES:
+        print("Unknown device %s, known devices are %s" % (name, ", ".join(sorted(PROFILES))))
+        sys.exit(2)
+    return PROFILES[name]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        protocol.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Byte level definition of the SB01 bootloader protocol, shared by the
+# downloader and the emulator.
+#
+# All addresses are word addresses. One instruction is 24 bits and takes two
+# words. In a hex file each instruction takes 4 bytes, the 4th being a
+# phantom byte that is not stored in flash.
+
+import binascii
+
+ERASE_CMD = 0x45
+ADR_CMD = 0x85
+DATA_CMD1 = 0xC7
+DATA_CMD2 = 0xCD
+DATA_CMD3 = 0xD3
+DATA_CMD4 = 0xD9
+AUX_CMD = 0x02
+CRC_CMD = 0x01
+START_CMD = 0x02
+REV_CMD = 0x03
+READ_WORD = 0x04
+READ_DWORD = 0x05
+OK_RESP = 0x0A
+ERR_RESP = 0xAA
+QUERY_CMD = 0x61
+
+# Flash geometry, in word addresses. The reset vector below APP_START
+# belongs to the bootloader.
+FLASH_END = 0x5000
+PAGE_SIZE = 0x800
+APP_START = 0x0004
+
+# Baud rates tried when the rate is negotiated, fastest first. A rate is
+# used if the bootloader answers get_rev at it.
+DEFAULT_BAUDRATE = 19200
+BAUD_LADDER = (460800, 230400, 115200, 57600, 38400, 19200)
+
+# Length of a command frame including the command byte, indexed by the
+# command byte. The low 6 bits of the erase, address and data commands
+# hold the frame length.
+FRAME_LENGTH = {
+    ERASE_CMD: 5,
+    ADR_CMD: 5,
+    DATA_CMD1: 7,
+    DATA_CMD2: 13,
+    DATA_CMD3: 19,
+    DATA_CMD4: 25,
+    AUX_CMD: 2,
+}
+
+# Data commands by the number of 6 byte frames (2 instructions each) they
+# carry. Each is acked once.
+DATA_CMDS = (DATA_CMD1, DATA_CMD2, DATA_CMD3, DATA_CMD4)
+
+# First bootloader revision assumed to accept DATA_CMD2 to DATA_CMD4. No
+# bootloader release documents these commands, so this has not been checked
+# on hardware. Limit the frames with DeviceProfile.max_frames or --frames.
+MULTI_FRAME_REVISION = (1, 1)
+
+
+def frames_per_command(revision):
+    """ The most frames the bootloader with the 2 byte revision is assumed
+    to accept in one data command """
+    if len(revision) == 2 and tuple(revision) >= MULTI_FRAME_REVISION:
+        return len(DATA_CMDS)
+    return 1
+
+
+def crc16(data, crc=0xFFFF):
+    """ CRC-16/CCITT (polynomial 0x1021) over data, continuing from crc.
+    This is assumed to be the CRC the bootloader returns for CRC_CMD, with
+    init 0xFFFF, sent low byte first. It has not been checked against the
+    bootloader source, DeviceProfile holds the algorithm so it can be
+    changed as data. """
+    return binascii.crc_hqx(data, crc)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+# -------------------------------------------------------------------------------
+# Name:        test_downloader.py
+# Author:      Jan Kåre Vatne
+# -------------------------------------------------------------------------------
+# Regression tests of the downloader against the bootloader emulator.
+# Run with python -m pytest. The emulator runs on a simulated clock, only
+# the station test uses a pseudo terminal and needs a POSIX system.
+
+import io
+import os
+import sys
+import threading
+import pytest
+import downloader
+import emulator
+import intelhex
+import ports
+from benchmark import synthetic_hex
+from checkpoint import Checkpoint
+from flashimage import FlashImage
+from protocol import DATA_CMDS
+
+
+def make_image(size=0x4000, seed=1, sparsity=0.0):
+    return FlashImage.from_hex(intelhex.IntelHex(io.StringIO(synthetic_hex(size, sparsity, seed=seed))))
+
+
+def changed(image, word):
+    """ image with the instruction at word address word changed """
+    data = bytearray(image.data)
+    data[word * 2] ^= 0xFF
+    return FlashImage(bytes(data), image.profile)
+
+
+def connect(device, loss_rate=0.0):
+    link = emulator.SB01Emulator(device, baudrate=115200, latency=0.004, erase_time=0.025, realtime=False,
+                                 loss_rate=loss_rate)
+    return downloader.SB01("emulator", com=link)
+
+
+def run(image, device=None, loss_rate=0.0, **options):
+    """ Program image on device, returns the device, the ranges that failed
+    verify and the log """
+    if device is None:
+        device = emulator.SB01Device()
+    messages = []
+    board = connect(device, loss_rate)
+    try:
+        board.get_rev(log=messages.append)
+        errors = downloader.program(board, image, log=messages.append, **options)
+    finally:
+        board.close()
+    return device, errors, messages
+
+
+@pytest.mark.parametrize("revision", [(1, 0), (1, 1)])
+def test_program(revision):
+    image = make_image()
+    device, errors, messages = run(image, emulator.SB01Device(revision=revision))
+    assert errors == []
+    assert device.crc() == image.crc()
+
+
+def test_program_over_other_image():
+    device, errors, messages = run(make_image(seed=2, size=0x8000))
+    image = make_image(sparsity=0.5)
+    device, errors, messages = run(image, device)
+    assert errors == []
+    assert device.crc() == image.crc()
+
+
+def test_program_same_image_diff():
+    image = make_image()
+    device, errors, messages = run(image)
+    device, errors, messages = run(image, device, diff=True)
+    assert errors == []
+    assert "The card already holds this hex file" in messages
+
+
+@pytest.mark.parametrize("use_base", [False, True])
+def test_program_one_page(use_base):
+    image = make_image()
+    new = changed(image, 0x1234)
+    device, errors, messages = run(image)
+    if use_base:
+        device, errors, messages = run(new, device, base=image)
+    else:
+        device, errors, messages = run(new, device, diff=True)
+    assert errors == []
+    assert device.crc() == new.crc()
+    assert any(msg.startswith("Erasing and writing 1 of") for msg in messages)
+
+
+def test_base_not_on_card():
+    image = make_image()
+    new = changed(image, 0x1234)
+    device, errors, messages = run(make_image(seed=2))
+    device, errors, messages = run(new, device, base=image)
+    assert errors == []
+    assert device.crc() == new.crc()
+    assert "The card does not hold the base hex file, reading back flash" in messages
+
+
+class Interrupted(Exception):
+    pass
+
+
+class InterruptedCheckpoint(Checkpoint):
+    """ A Checkpoint interrupting the download after pages pages """
+
+    def __init__(self, pages, *args, **kwargs):
+        Checkpoint.__init__(self, *args, **kwargs)
+        self.limit = pages
+
+    def record(self, page):
+        Checkpoint.record(self, page)
+        if len(self.pages) == self.limit:
+            raise Interrupted()
+
+
+def test_resume(tmp_path):
+    image = make_image()
+    device = emulator.SB01Device()
+    board = connect(device)
+    checkpoint = InterruptedCheckpoint(3, "emulator", image, directory=str(tmp_path))
+    with pytest.raises(Interrupted):
+        downloader.program(board, image, log=lambda msg: None, checkpoint=checkpoint)
+    board.close()
+    written = Checkpoint("emulator", image, resume=True, directory=str(tmp_path)).pages
+    assert len(written) == 3
+    checkpoint = Checkpoint("emulator", image, resume=True, directory=str(tmp_path))
+    device, errors, messages = run(image, device, checkpoint=checkpoint)
+    assert errors == []
+    assert device.crc() == image.crc()
+    assert "Resuming after page 0x%04X" % written[-1] in messages
+    assert not os.path.exists(checkpoint.path)
+
+
+def test_resume_other_image(tmp_path):
+    image = make_image()
+    checkpoint = InterruptedCheckpoint(3, "emulator", image, directory=str(tmp_path))
+    with pytest.raises(Interrupted):
+        run(image, checkpoint=checkpoint)
+    checkpoint = Checkpoint("emulator", make_image(seed=2), resume=True, directory=str(tmp_path))
+    assert checkpoint.pages == []
+
+
+@pytest.mark.parametrize("suffix", [".hex", ".bin"])
+def test_dump(tmp_path, suffix):
+    image = make_image(sparsity=0.3)
+    device, errors, messages = run(image)
+    filename = str(tmp_path / ("dump" + suffix))
+    board = connect(device)
+    try:
+        downloader.dump_flash(board, filename)
+    finally:
+        board.close()
+    if suffix == ".bin":
+        with open(filename, "rb") as f:
+            assert f.read() == bytes(device.flash)
+    else:
+        dumped = downloader.load_image(filename, use_cache=False)
+        assert dumped.crc() == image.crc()
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_errors_and_drops(seed):
+    image = make_image()
+    device = emulator.SB01Device(error_rate=0.01, drop_rate=0.01, seed=seed)
+    device, errors, messages = run(image, device)
+    assert errors == []
+    assert device.errors > 0 and device.dropped > 0
+    assert device.crc() == image.crc()
+
+
+def test_loss():
+    image = make_image()
+    device, errors, messages = run(image, loss_rate=1e-4)
+    assert errors == []
+    assert device.crc() == image.crc()
+
+
+def test_no_multi_frame_commands():
+    """ A bootloader not knowing the multi frame data commands it is
+    assumed to have gets single frame commands """
+    image = make_image()
+    device = emulator.SB01Device(revision=(1, 1))
+    for cmd in DATA_CMDS[1:]:
+        del device.frame_length[cmd]
+    device, errors, messages = run(image, device)
+    assert errors == []
+    assert device.crc() == image.crc()
+
+
+@pytest.mark.skipif(not hasattr(os, "openpty"), reason="needs a pseudo terminal")
+def test_station(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+    image = make_image(size=0x1000)
+    devices = [emulator.SB01Device() for i in range(2)]
+    ptys = [emulator.PtyEmulator(device, baudrate=115200) for device in devices]
+    for pty in ptys:
+        pty.start()
+    listener = ports.SimulatedListener()
+    reports = []
+    try:
+        for pty in ptys:
+            listener.attach(pty.port)
+        listener.detach(ptys[0].port)
+        threading.Timer(0.5, listener.close).start()
+        ok, failed = downloader.station(image, listener, report=lambda: reports.append(1), baudrate=115200)
+    finally:
+        for pty in ptys:
+            pty.stop()
+    assert (ok, failed) == (2, 0)
+    assert len(reports) == 2
+    for device in devices:
+        assert device.crc() == image.crc()
+        assert device.started
+
+
+if __name__ == "__main__":
+    sys.exit(pytest.main([__file__]))